@@ -0,0 +1,310 @@
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import glob
+import json
+import mmap
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+import pymupdf
+import zxingcpp
+
+import db_pkpass
+
+
+def _put(page, x, y, text):
+    page.insert_text((x, y), text, fontsize=9)
+
+
+def generate_ticket(
+    path, legs=2, extra_pages=0, barcode_scale=4, ads=0, banner=False
+):
+    # Lays out text the way iter_lines expects from real DB tickets: one
+    # block per column, later columns slightly higher so they stay on the
+    # same line.
+    doc = pymupdf.open()
+    page = doc.new_page()
+    _put(page, 40, 40, 'Online-Ticket')
+    _put(page, 40, 70, 'Flexpreis (Einfache Fahrt)')
+    _put(page, 40, 100, 'Hinfahrt:\nAuftragsnummer: 123456789')
+    _put(page, 40, 140, 'Gültigkeit: 22.04.2022 bis 23.04.2022')
+    _put(page, 40, 170, 'Halt\nDatum\nZeit\nGleis')
+
+    y = 260
+    for i in range(legs):
+        if y > 760:
+            page = doc.new_page()
+            y = 60
+        hour = 6 + i * 14 // legs
+        _put(page, 40, y, f'Stadt {i}\nStadt {i + 1}')
+        _put(page, 150, y - 3, '22.04.\n22.04.')
+        _put(page, 230, y - 6, f'ab {hour:02}:00\nan {hour:02}:30')
+        _put(page, 310, y - 9, '1\n2')
+        _put(page, 370, y - 12, f'ICE {100 + i}')
+        y += 60
+    _put(page, 40, y + 20, 'Wichtige Nutzungshinweise:\nBitte beachten')
+
+    rng = numpy.random.default_rng(0)
+    if banner:
+        # inserted before the barcode, so it comes first in get_images()
+        noise = rng.integers(0, 255, (600, 1800, 3), numpy.uint8)
+        _, jpg = cv2.imencode('.jpg', noise)
+        doc[0].insert_image(pymupdf.Rect(40, 780, 550, 830), stream=jpg.tobytes())
+        _, rule = cv2.imencode('.png', numpy.zeros((4, 1000), numpy.uint8))
+        doc[0].insert_image(pymupdf.Rect(40, 190, 550, 192), stream=rule.tobytes())
+
+    barcode = zxingcpp.create_barcode(
+        'synthetic ticket ' * 8, zxingcpp.BarcodeFormat.Aztec
+    )
+    img = numpy.array(barcode.to_image(scale=barcode_scale))
+    _, png = cv2.imencode('.png', img)
+    doc[0].insert_image(pymupdf.Rect(400, 20, 550, 170), stream=png.tobytes())
+
+    for i in range(extra_pages):
+        page = doc.new_page()
+        _put(page, 40, 40, 'Wichtige Nutzungshinweise\n' + 'Lorem ipsum\n' * 40)
+        if i < ads:
+            noise = rng.integers(0, 255, (600, 1800, 3), numpy.uint8)
+            _, jpg = cv2.imencode('.jpg', noise)
+            rect = pymupdf.Rect(40, 600, 550, 770)
+            page.insert_image(rect, stream=jpg.tobytes())
+
+    doc.save(path)
+
+
+SYNTHETIC = {
+    'synthetic_small': {},
+    'synthetic_many_legs': {'legs': 24},
+    'synthetic_large_barcode': {'barcode_scale': 24},
+    'synthetic_multi_page': {'extra_pages': 8, 'ads': 4},
+    'synthetic_banner': {'banner': True},
+}
+
+
+def _stages(data):
+    pdf = pymupdf.open(stream=data)
+    lines = list(db_pkpass.iter_lines(pdf))
+    content = db_pkpass.extract_content(pdf)
+    stages = {
+        'open': lambda: pymupdf.open(stream=data),
+        'iter_lines': lambda: list(db_pkpass.iter_lines(pdf)),
+        'extract_header': lambda: db_pkpass.extract_header(iter(lines)),
+        'extract': lambda: db_pkpass.extract(pdf),
+        'extract_barcodes': lambda: db_pkpass.extract_barcodes(pdf),
+        'extract_barcodes_color': lambda: db_pkpass.extract_barcodes(
+            pdf, decode='color'
+        ),
+        'extract_content': lambda: db_pkpass.extract_content(pdf),
+        'dump_pkpass': lambda: db_pkpass.dump_pkpass(
+            db_pkpass.pass_files(content)
+        ),
+    }
+    # decoding alone, on the image that is tried first
+    page = pdf[0]
+    xrefs = db_pkpass.barcode_candidates(page, page.get_images(full=True))
+    if xrefs:
+        img_data = pdf.extract_image(xrefs[0])
+        for decode in ['gray', 'color']:
+            stages[f'read_barcodes_{decode}'] = functools.partial(
+                db_pkpass.read_barcodes, img_data, decode
+            )
+    return stages
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(fn, runs):
+    fn()  # warm up
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {
+        'runs': runs,
+        'mean_ms': statistics.mean(times) * 1000,
+        'p50_ms': _percentile(times, 50) * 1000,
+        'p90_ms': _percentile(times, 90) * 1000,
+        'p99_ms': _percentile(times, 99) * 1000,
+        'per_second': runs / sum(times),
+    }
+
+
+def bench(paths, runs):
+    results = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        results[name] = {
+            stage: measure(fn, runs) for stage, fn in _stages(data).items()
+        }
+        p50 = results[name]['extract_content']['p50_ms']
+        print(f'{name}: {p50:.1f} ms', file=sys.stderr)
+        if 'read_barcodes_gray' in results[name]:
+            gray = results[name]['read_barcodes_gray']['p50_ms']
+            color = results[name]['read_barcodes_color']['p50_ms']
+            print(
+                f'  read_barcodes: gray {gray:.1f} ms, color {color:.1f} ms',
+                file=sys.stderr,
+            )
+    return results
+
+
+def _status(key):
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith(f'{key}:'):
+                return int(line.split()[1])
+
+
+def _load(path, how):
+    # reset the peak RSS (Linux only), so only the growth above the
+    # current RSS is measured, not the peak from importing libraries
+    with open('/proc/self/clear_refs', 'w') as fh:
+        fh.write('5')
+    rss = _status('VmRSS')
+    if how == 'read':  # how the CLI opened PDFs before open_pdf
+        with open(path, 'rb') as fh:
+            db_pkpass.load_content(fh.read(), {}, cache=False)
+    elif how == 'mmap':
+        with open(path, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                db_pkpass.load_content(buf, {}, cache=False)
+    else:
+        db_pkpass.load_content(path, {}, cache=False)
+    return _status('VmHWM') - rss
+
+
+def peak_rss(paths):
+    # every measurement gets a fresh process so that memory freed by
+    # earlier runs cannot be reused
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        results[name] = {'size_kib': os.path.getsize(path) // 1024}
+        for how in ['read', 'mmap', 'path']:
+            with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=ctx, initializer=db_pkpass._warm_up
+            ) as executor:
+                kib = executor.submit(_load, path, how).result()
+            results[name][f'{how}_kib'] = kib
+    return results
+
+
+def decode_tiers(paths):
+    # which tier of the decode ladder found the barcodes of each fixture
+    results = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        db_pkpass.DECODE_STATS.clear()
+        db_pkpass.extract_content(pymupdf.open(path))
+        results[name] = dict(db_pkpass.DECODE_STATS)
+    return results
+
+
+def _strptime_validity(text):
+    # the parser used before parse_date, kept for comparison
+    def strptime(s, _format):
+        return datetime.datetime.strptime(s, _format).astimezone(db_pkpass.TZ)
+
+    s_start, s_end = text.split(' bis ')
+    try:
+        return (
+            strptime(s_start, '%d.%m.%Y %H:%M Uhr'),
+            strptime(s_end, '%d.%m.%Y %H:%M Uhr'),
+        )
+    except ValueError:
+        return strptime(s_start, '%d.%m.%Y'), strptime(s_end, '%d.%m.%Y')
+
+
+def bench_dates(runs):
+    texts = [f'{d:02}.04.2022 bis {d + 1:02}.04.2022' for d in range(1, 29)]
+
+    def uncached():
+        db_pkpass.parse_date.cache_clear()
+        for text in texts:
+            db_pkpass.parse_validity(text)
+
+    def strptime():
+        for text in texts:
+            _strptime_validity(text)
+
+    def cached():
+        for text in texts:
+            db_pkpass.parse_validity(text)
+
+    return {
+        'strptime': measure(strptime, runs),
+        'parse_date': measure(uncached, runs),
+        'parse_date_cached': measure(cached, runs),
+    }
+
+
+def compare(old, new):
+    for name, stages in new.items():
+        for stage, result in stages.items():
+            try:
+                before = old[name][stage]['p50_ms']
+            except KeyError:
+                continue
+            after = result['p50_ms']
+            print(
+                f'{name:40} {stage:18} {before:8.2f} -> {after:8.2f} ms'
+                f'  x{after / before:.2f}'
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='time the stages of db_pkpass per fixture'
+    )
+    parser.add_argument(
+        'paths',
+        nargs='*',
+        help='ticket PDFs (default: muster/*.pdf and synthetic tickets)',
+    )
+    parser.add_argument('-n', '--runs', type=int, default=20)
+    parser.add_argument('-o', '--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.paths
+        if not paths:
+            paths = sorted(glob.glob('muster/*.pdf'))
+            for name, kwargs in SYNTHETIC.items():
+                path = os.path.join(tmp, f'{name}.pdf')
+                generate_ticket(path, **kwargs)
+                paths.append(path)
+        results = {
+            'version': db_pkpass.VERSION,
+            'python': platform.python_version(),
+            'fixtures': bench(paths, args.runs),
+            'dates': bench_dates(args.runs),
+            'peak_rss': peak_rss(paths),
+            'decode_tiers': decode_tiers(paths),
+        }
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(json.load(fh)['fixtures'], results['fixtures'])
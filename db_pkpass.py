@@ -1,33 +1,98 @@
 import argparse
 import base64
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
 import datetime
+import functools
+import glob
 import hashlib
 import io
+import itertools
 import json
 import os
+import re
+import select
+import shutil
+import signal
+import struct
+import sys
+import threading
+import time
+import warnings
 import zipfile
+from collections.abc import Callable, Iterable
+from typing import BinaryIO
 from zoneinfo import ZoneInfo
 
-import cv2
-import numpy
-import pymupdf
-import zxingcpp
+# cv2, numpy, pymupdf and zxingcpp are slow to import and only needed for
+# extraction, so they are imported where they are used. That way packing
+# JSON and the service frontend start quickly.
 
 BARCODES = {
-    zxingcpp.BarcodeFormat.Aztec: 'PKBarcodeFormatAztec',
-    zxingcpp.BarcodeFormat.Code128: 'PKBarcodeFormatCode128',
-    zxingcpp.BarcodeFormat.PDF417: 'PKBarcodeFormatPDF417',
-    zxingcpp.BarcodeFormat.QRCode: 'PKBarcodeFormatQR',
+    'Aztec': 'PKBarcodeFormatAztec',
+    'Code128': 'PKBarcodeFormatCode128',
+    'PDF417': 'PKBarcodeFormatPDF417',
+    'QRCode': 'PKBarcodeFormatQR',
 }
-BARCODE_FORMATS = zxingcpp.BarcodeFormats(
-    zxingcpp.BarcodeFormat.Aztec
-    or zxingcpp.BarcodeFormat.Code128
-    or zxingcpp.BarcodeFormat.PDF417
-    or zxingcpp.BarcodeFormat.QRCode
-)
 
 TZ = ZoneInfo('Europe/Berlin')
 
+# bump whenever a change affects the generated pass.json
+VERSION = 4
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'db_pkpass',
+)
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+CACHE_MAX_AGE = datetime.timedelta(days=30)
+# entries written between evictions, for --watch and --serve, which never
+# reach the eviction at the end of a batch run
+CACHE_EVICT_INTERVAL = 100
+CACHE_STATS = collections.Counter()
+
+CHUNK_SIZE = 64 * 1024
+
+# the decode ladder tries images at reduced resolution first if they are
+# at least this large (in pixels) after reduction
+REDUCED_SIZE = 1000
+RENDER_DPI = 300
+# the tier of the decode ladder at which barcodes were found per image
+DECODE_STATS = collections.Counter()
+
+# images that cannot hold a barcode are not decoded: the smallest Aztec
+# code (as on DB tickets) has 15 modules, anything placed smaller than half
+# an inch cannot be scanned and very long thin images are rules or
+# decoration
+MIN_BARCODE_PIXELS = 15
+MIN_BARCODE_POINTS = 36
+MAX_BARCODE_ASPECT = 12
+# images skipped by barcode_candidates() per reason
+SKIP_STATS = collections.Counter()
+
+# Budgets that bound the memory used per document: decoded pixels per
+# image and in total (one byte each in gray, three in color) and pages.
+# None means unlimited.
+MAX_IMAGE_PIXELS = 16_000_000
+MAX_TOTAL_PIXELS = 64_000_000
+MAX_TOTAL_PAGES = 100
+# decoded pixels and reduced or skipped images, summed over documents
+BUDGET_STATS = collections.Counter()
+
+# list of trace events while profiling, see profile()
+TRACE = None
+
+# (compression, compresslevel) by file extension, '' is the fallback.
+# PNG is already compressed, so deflating it only costs time.
+COMPRESSION = {
+    '.json': (zipfile.ZIP_DEFLATED, 9),
+    '.png': (zipfile.ZIP_STORED, None),
+    '': (zipfile.ZIP_DEFLATED, 6),
+}
+
 ICON = base64.b64decode("""
 iVBORw0KGgoAAAANSUhEUgAAAEAAAABACAMAAACdt4HsAAAAAXNSR0IArs4c6QAAAARnQU1BAACx
 jwv8YQUAAAAgY0hSTQAAeiYAAICEAAD6AAAAgOgAAHUwAADqYAAAOpgAABdwnLpRPAAAADNQTFRF
@@ -43,49 +108,655 @@ zrZnxLFzHHGGh6yxMY+FQXHUf3zUffXqC/QDnptJNAYwk4oAAAAASUVORK5CYII=
 """.strip())
 
 
-def dump_pkpass(files: dict[str, bytes]) -> bytes:
+def get_compression(path, compression):
+    ext = os.path.splitext(path)[1]
+    return compression.get(ext, compression[''])
+
+
+def _write_entry(zfh, path, content, compression):
+    if isinstance(content, bytes):
+        content = [content]
+    h = hashlib.sha1()
+    zfh.compression, zfh.compresslevel = get_compression(path, compression)
+    with zfh.open(path, 'w') as zfh_entry:
+        for chunk in content:
+            zfh_entry.write(chunk)
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_manifest(zfh, manifest, compression, sign):
+    manifest_bytes = json.dumps(manifest).encode('utf-8')
+    _write_entry(zfh, 'manifest.json', manifest_bytes, compression)
+    if sign:
+        with span('sign'):
+            signature = sign(manifest_bytes)
+        _write_entry(zfh, 'signature', signature, compression)
+
+
+def write_pkpass(
+    fh: BinaryIO,
+    files: dict[str, bytes | Iterable[bytes]],
+    compression: dict[str, tuple[int, int | None]] = COMPRESSION,
+    sign: Callable[[bytes], bytes] | None = None,
+) -> list[zipfile.ZipInfo]:
     # https://developer.apple.com/documentation/walletpasses
     # https://file-extensions.com/docs/pkpass
 
-    buf = io.BytesIO()
+    # fh does not need to be seekable, so this also works with pipes and
+    # sockets. Content may be given as chunks to avoid holding it in memory.
     manifest = {}
 
-    with zipfile.ZipFile(buf, 'w') as zfh:
+    with span('write_pkpass'), zipfile.ZipFile(fh, 'w') as zfh:
+        for path, content in files.items():
+            manifest[path] = _write_entry(zfh, path, content, compression)
+        _write_manifest(zfh, manifest, compression, sign)
+
+    return zfh.infolist()
+
+
+def _copy_raw(zin, info, zout):
+    # zipfile has no public API to copy an entry without recompressing it,
+    # so this writes the local header and compressed data by hand
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    zin.fp.seek(name_len + extra_len, os.SEEK_CUR)
+
+    new = copy.copy(info)
+    # sizes and CRC are known, so no data descriptor is needed
+    new.flag_bits &= ~0x08
+    new.header_offset = zout.fp.tell()
+    zout.fp.write(new.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = zin.fp.read(min(remaining, CHUNK_SIZE))
+        zout.fp.write(chunk)
+        remaining -= len(chunk)
+    zout.filelist.append(new)
+    zout.NameToInfo[new.filename] = new
+    zout.start_dir = zout.fp.tell()
+
+
+def repack_pkpass(
+    src: str | BinaryIO,
+    fh: BinaryIO,
+    files: dict[str, bytes | Iterable[bytes]],
+    compression: dict[str, tuple[int, int | None]] = COMPRESSION,
+    sign: Callable[[bytes], bytes] | None = None,
+) -> list[zipfile.ZipInfo]:
+    # Writes the pkpass archive src to fh with files (e.g. pass.json)
+    # replaced. All other entries are copied as compressed data and keep
+    # their hash from the existing manifest.
+    with (
+        span('repack_pkpass'),
+        zipfile.ZipFile(src) as zin,
+        zipfile.ZipFile(fh, 'w') as zout,
+    ):
+        old_manifest = json.loads(zin.read('manifest.json'))
+        if 'signature' in zin.namelist() and sign is None:
+            # the old signature does not match the new manifest
+            warnings.warn(
+                'dropping the signature of the repacked pass, no signer given'
+            )
+        manifest = {}
+        for info in zin.infolist():
+            name = info.filename
+            if name in files or name in ['manifest.json', 'signature']:
+                continue
+            _copy_raw(zin, info, zout)
+            if name in old_manifest:
+                manifest[name] = old_manifest[name]
+            else:
+                manifest[name] = hashlib.sha1(zin.read(info)).hexdigest()
         for path, content in files.items():
-            with zfh.open(path, 'w') as fh:
-                fh.write(content)
-            manifest[path] = hashlib.sha1(content).hexdigest()
+            manifest[path] = _write_entry(zout, path, content, compression)
+        _write_manifest(zout, manifest, compression, sign)
+
+    return zout.infolist()
+
+
+def write_pkpasses(
+    fh: BinaryIO,
+    bundle: list[dict[str, bytes | Iterable[bytes]]],
+    compression: dict[str, tuple[int, int | None]] = COMPRESSION,
+    sign: Callable[[bytes], bytes] | None = None,
+) -> None:
+    # A .pkpasses bundle is a zip archive of .pkpass files. Each pass is
+    # streamed straight into it.
+    with zipfile.ZipFile(fh, 'w') as zfh:
+        for i, files in enumerate(bundle, 1):
+            with zfh.open(f'{i}.pkpass', 'w') as zfh_entry:
+                write_pkpass(zfh_entry, files, compression, sign)
 
-        manifest_bytes = json.dumps(manifest).encode('utf-8')
-        with zfh.open('manifest.json', 'w') as fh:
-            fh.write(manifest_bytes)
 
+def dump_pkpass(
+    files: dict[str, bytes | Iterable[bytes]],
+    compression: dict[str, tuple[int, int | None]] = COMPRESSION,
+    sign: Callable[[bytes], bytes] | None = None,
+) -> bytes:
+    buf = io.BytesIO()
+    write_pkpass(buf, files, compression, sign)
     return buf.getvalue()
 
 
-def strptime(s, _format):
-    return datetime.datetime.strptime(s, _format).astimezone(TZ)
+@functools.cache
+def load_signer(cert_path, key_path, wwdr_path=None, password=None):
+    # Returns a function that creates the detached PKCS#7 signature of a
+    # manifest. Key material is loaded once per process and reused.
+    # Requires the optional cryptography package.
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
 
+    with open(cert_path, 'rb') as fh:
+        cert = x509.load_pem_x509_certificate(fh.read())
+    with open(key_path, 'rb') as fh:
+        key = serialization.load_pem_private_key(fh.read(), password)
 
-def extract_barcodes(pdf):
-    barcodes = []
+    builder = pkcs7.PKCS7SignatureBuilder().add_signer(
+        cert, key, hashes.SHA256()
+    )
+    if wwdr_path:
+        with open(wwdr_path, 'rb') as fh:
+            wwdr = x509.load_pem_x509_certificate(fh.read())
+        builder = builder.add_certificate(wwdr)
+
+    def sign(data):
+        return builder.set_data(data).sign(serialization.Encoding.DER, [
+            pkcs7.PKCS7Options.DetachedSignature,
+            pkcs7.PKCS7Options.Binary,
+        ])
+
+    return sign
+
+
+@functools.cache
+def load_identifiers(cert_path):
+    # Wallet rejects signed passes unless passTypeIdentifier and
+    # teamIdentifier match the UID and OU of the pass type certificate
+    from cryptography import x509
+
+    with open(cert_path, 'rb') as fh:
+        cert = x509.load_pem_x509_certificate(fh.read())
+    identifiers = {}
+    for key, name, oid in [
+        ('passTypeIdentifier', 'UID', x509.NameOID.USER_ID),
+        ('teamIdentifier', 'OU', x509.NameOID.ORGANIZATIONAL_UNIT_NAME),
+    ]:
+        attributes = cert.subject.get_attributes_for_oid(oid)
+        if not attributes:
+            raise ValueError(
+                f'{cert_path}: no {name} in the subject, not a pass type '
+                'certificate'
+            )
+        identifiers[key] = attributes[0].value
+    return identifiers
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    # Records a Chrome trace event while profiling. The yielded dict can be
+    # used to attach more args, e.g. values that are only known afterwards.
+    if TRACE is None:
+        yield args
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        TRACE.append({
+            'name': name,
+            'ph': 'X',
+            'ts': start / 1000,
+            'dur': (time.perf_counter_ns() - start) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+
+@contextlib.contextmanager
+def profile():
+    global TRACE
+    previous, TRACE = TRACE, []
+    try:
+        yield TRACE
+    finally:
+        TRACE = previous
+
+
+def write_trace(events, path):
+    # can be opened in chrome://tracing or https://ui.perfetto.dev
+    with open(path, 'w') as fh:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+
+LENGTH_RE = re.compile(r'/Length\s*\d+(?:\s+\d+\s+R)?')
+REF_RE = re.compile(r'\b(\d+) \d+ R\b')
+DATE_RE = re.compile(r'(\d\d?)\.(\d\d?)\.(\d{4})(?: (\d\d?):(\d\d) Uhr)?')
+LEG_DATE_RE = re.compile(r'(\d\d?)\.(\d\d?)\. (ab|an) (\d\d?):(\d\d)')
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_date(s):
+    # '%d.%m.%Y' or '%d.%m.%Y %H:%M Uhr', in local time
+    m = DATE_RE.fullmatch(s)
+    if not m:
+        raise ValueError(f'invalid date: {s!r}')
+    day, month, year, hour, minute = (int(g or 0) for g in m.groups())
+    return datetime.datetime(year, month, day, hour, minute, tzinfo=TZ)
+
+
+@functools.cache
+def barcode_formats():
+    import zxingcpp
+
+    return zxingcpp.BarcodeFormats(
+        zxingcpp.BarcodeFormat.Aztec
+        or zxingcpp.BarcodeFormat.Code128
+        or zxingcpp.BarcodeFormat.PDF417
+        or zxingcpp.BarcodeFormat.QRCode
+    )
+
+
+def read_barcodes(img_data, decode='gray', reduce=1):
+    import cv2
+    import numpy
+    import zxingcpp
+
+    flags = {
+        ('gray', 1): cv2.IMREAD_GRAYSCALE,
+        ('gray', 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        ('gray', 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        ('gray', 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+        ('color', 1): cv2.IMREAD_COLOR,
+        ('color', 2): cv2.IMREAD_REDUCED_COLOR_2,
+        ('color', 4): cv2.IMREAD_REDUCED_COLOR_4,
+        ('color', 8): cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    arr = numpy.frombuffer(img_data['image'], numpy.uint8)
+    kwargs = {'formats': barcode_formats()}
+    with span('imdecode', ext=img_data['ext'], reduce=reduce) as args:
+        # for gray, barcodes only need luminance, a third of the memory of BGR
+        img = cv2.imdecode(arr, flags[decode, reduce])
+        if img is None:
+            # e.g. JBIG2 or JPX, which OpenCV cannot decode
+            return []
+        if decode == 'gray' and reduce == 1 and img_data['bpc'] == 1:
+            # already bilevel, so there is nothing left to binarize
+            kwargs['binarizer'] = zxingcpp.Binarizer.BoolCast
+        args['height'], args['width'] = img.shape[:2]
+    with span('read_barcodes', **args):
+        return zxingcpp.read_barcodes(img, **kwargs)
+
+
+def render_barcodes(page, rects):
+    import numpy
+    import pymupdf
+    import zxingcpp
+
+    results = []
+    for rect in rects:
+        with span('get_pixmap', page=page.number, dpi=RENDER_DPI) as args:
+            pix = page.get_pixmap(
+                clip=rect, dpi=RENDER_DPI, colorspace=pymupdf.csGRAY
+            )
+            args['height'], args['width'] = pix.height, pix.width
+        img = numpy.frombuffer(pix.samples, numpy.uint8).reshape(
+            pix.height, pix.stride
+        )[:, :pix.width]
+        with span('read_barcodes', **args):
+            results += zxingcpp.read_barcodes(img, formats=barcode_formats())
+    return results
+
+
+def _ladder_reduce(size, reduce=1):
+    # the reduced tier of the decode ladder that large images try first
+    for r in [8, 4, 2]:
+        if r > reduce and size // r >= REDUCED_SIZE:
+            return r
+    return None
+
+
+def _pixels(width, height, reduce=1):
+    return -(-width // reduce) * -(-height // reduce)
+
+
+def charge(budget, pixels, what, extra=0):
+    # Counts pixels, plus extra pixels decoded on the way, against the
+    # budget, or warns and returns False if they do not fit. budget is a
+    # dict of the limits and a Counter of what was used.
+    limit = budget['max_image_pixels']
+    total = budget['max_total_pixels']
+    used = budget['used']
+    if limit is not None and pixels > limit:
+        reason = f'more than {limit} per image'
+    elif total is not None and used['pixels'] + pixels + extra > total:
+        reason = f'only {total - used["pixels"]} of {total} left'
+    else:
+        used['pixels'] += pixels + extra
+        return True
+    used['skipped'] += 1
+    warnings.warn(f'skipping {what}: {pixels} pixels, {reason}')
+    return False
+
+
+def budget_reduce(budget, item, ladder=True):
+    # Returns the factor by which an item of page.get_images() has to be
+    # reduced to fit the budget, or None if it has to be skipped. Only JPEG
+    # streams are passed to OpenCV as they are, so only they can be decoded
+    # at reduced scale; anything else is decoded at full size by MuPDF.
+    xref, _, width, height, _, _, _, _, _filter, _ = item
+    limit = budget['max_image_pixels']
+    for reduce in [1, 2, 4, 8] if _filter == 'DCTDecode' else [1]:
+        if limit is None or _pixels(width, height, reduce) <= limit:
+            break
+    extra = 0
+    if ladder and (r := _ladder_reduce(max(width, height), reduce)):
+        extra = _pixels(width, height, r)
+    what = f'{width}x{height} image {xref}'
+    if not charge(budget, _pixels(width, height, reduce), what, extra):
+        return None
+    if reduce > 1:
+        budget['used']['reduced'] += 1
+        warnings.warn(
+            f'decoding {what} at 1/{reduce} scale to stay within {limit} '
+            'pixels'
+        )
+    return reduce
+
+
+def decode_data(img_data, decode='gray', ladder=True, reduce=1):
+    # The part of the decode ladder that only needs the extracted image, so
+    # it can run in another thread: OpenCV and zxing-cpp release the GIL.
+    # Returns the results and the tier they were found at.
+    size = max(img_data['width'], img_data['height'])
+
+    if ladder and (r := _ladder_reduce(size, reduce)):
+        if results := read_barcodes(img_data, decode, r):
+            return results, 'reduced'
+
+    if results := read_barcodes(img_data, decode, reduce):
+        return results, 'native' if reduce == 1 else 'reduced'
+    return [], 'none'
+
+
+def finish_decode(
+    page, item, results, tier, ladder=True, budget=None, reduce=1
+):
+    # Images that fail at native resolution are rendered at RENDER_DPI,
+    # but only if that actually gives more pixels. Rendering makes MuPDF
+    # decode the whole image, so images that had to be reduced or skipped
+    # for the budget are not rendered. Uses PyMuPDF, so it must run on the
+    # thread that owns the document.
+    xref, _, width, height, _, _, _, _, _, _ = item
+    limit = None if budget is None else budget['max_image_pixels']
+    if (
+        not results
+        and ladder
+        and reduce == 1
+        and (limit is None or _pixels(width, height) <= limit)
+    ):
+        # unlike page.get_image_rects, this does not decode the image
+        bbox = page.get_image_bbox(item)
+        rects = [] if bbox.is_empty or bbox.is_infinite else [bbox]
+        scale = RENDER_DPI / 72
+        rendered = max((r.width for r in rects), default=0) * scale
+        pixels = sum(
+            _pixels(int(r.width * scale), int(r.height * scale)) for r in rects
+        )
+        if rendered > width and (
+            budget is None or charge(budget, pixels, f'rendering image {xref}')
+        ):
+            if results := render_barcodes(page, rects):
+                tier = 'render'
+    DECODE_STATS[tier] += 1
+    return results, tier
+
+
+def decode_image(
+    pdf, page, item, decode='gray', ladder=True, reduce=1, budget=None
+):
+    # With ladder, large images are first tried at reduced resolution and
+    # images that fail at native resolution are rendered. Returns the
+    # results and the tier they were found at.
+    img_data = pdf.extract_image(item[0])
+    results, tier = decode_data(img_data, decode, ladder, reduce)
+    return finish_decode(page, item, results, tier, ladder, budget, reduce)
+
+
+def decode_images(
+    pdf, images, decode='gray', ladder=True, memo=None, threads=1, budget=None
+):
+    # Takes (page, item of page.get_images(), digest) and yields the results
+    # for each in the same order. Images that do not fit the budget give no
+    # results. With threads, images are extracted here, because PyMuPDF is
+    # not thread-safe, and decoded in a thread pool. At most 2 * threads
+    # images are in flight, so consumers that stop early waste little work.
+    if memo is None:
+        memo = {}
+    if budget is None:
+        budget = {
+            'max_image_pixels': None,
+            'max_total_pixels': None,
+            'used': collections.Counter(),
+        }
+    if threads <= 1:
+        for page, item, digest in images:
+            xref = item[0]
+            if digest not in memo:
+                reduce = budget_reduce(budget, item, ladder)
+                if reduce is None:
+                    memo[digest] = []
+                    yield []
+                    continue
+                with span('image', page=page.number, xref=xref) as args:
+                    memo[digest], args['tier'] = decode_image(
+                        pdf, page, item, decode, ladder, reduce, budget
+                    )
+            yield memo[digest]
+        return
+
+    def finish(page, item, digest, reduce, future):
+        if future is None:
+            return memo[digest]
+        results, tier = future.result()
+        # only the part on this thread, the decoding is in 'imdecode' and
+        # 'read_barcodes' on the pool's threads
+        with span('image', page=page.number, xref=item[0]) as args:
+            memo[digest], args['tier'] = finish_decode(
+                page, item, results, tier, ladder, budget, reduce
+            )
+        return memo[digest]
+
+    executor = concurrent.futures.ThreadPoolExecutor(threads)
+    pending = collections.deque()
+    try:
+        for page, item, digest in images:
+            xref = item[0]
+            reduce = None
+            future = None
+            if digest not in memo:
+                reduce = budget_reduce(budget, item, ladder)
+                if reduce is None:
+                    memo[digest] = []
+                else:
+                    with span('extract_image', page=page.number, xref=xref):
+                        img_data = pdf.extract_image(xref)
+                    future = executor.submit(
+                        decode_data, img_data, decode, ladder, reduce
+                    )
+            pending.append((page, item, digest, reduce, future))
+            while pending and (
+                len(pending) >= 2 * threads
+                or pending[0][4] is None
+                or pending[0][4].done()
+            ):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def barcode_candidates(page, images):
+    # Takes items of page.get_images(full=True) and returns the xrefs that
+    # may hold a barcode, most likely first: square ones (Aztec, QR) before
+    # wide ones, lossless before lossy or transparent ones, top to bottom.
+    candidates = []
+    for item in images:
+        xref, smask, width, height, _, _, _, _, _filter, _ = item
+        if max(width, height) < MIN_BARCODE_PIXELS:
+            reason = 'too small'
+        else:
+            bbox = page.get_image_bbox(item)
+            short, long = sorted([bbox.width, bbox.height])
+            if bbox.is_empty or bbox.is_infinite:
+                reason = 'not placed'
+            elif long < MIN_BARCODE_POINTS:
+                reason = 'too small on page'
+            elif long > short * MAX_BARCODE_ASPECT:
+                reason = 'too narrow'
+            else:
+                lossy = _filter in ['DCTDecode', 'JPXDecode']
+                key = (long > short * 1.25, lossy or bool(smask), bbox.y0)
+                candidates.append((key, xref))
+                continue
+        SKIP_STATS[reason] += 1
+        with span('skip_image', page=page.number, xref=xref, reason=reason):
+            pass
+    return [xref for _, xref in sorted(candidates)]
+
+
+def image_digest(pdf, xref, h=None, path=()):
+    # Hashes the raw stream and the dictionary (/Decode, /SMask, ...) with
+    # indirect objects resolved, so copies of an image under other xrefs
+    # get the same digest. Only the /Length of the stream may differ.
+    h = hashlib.sha1() if h is None else h
+    obj = LENGTH_RE.sub('', pdf.xref_object(xref, compressed=True))
+    for i, part in enumerate(REF_RE.split(obj)):
+        if i % 2 == 0:
+            h.update(part.encode('utf-8'))
+        elif int(part) in path:
+            h.update(b'R')
+        else:
+            h.update(b'<')
+            image_digest(pdf, int(part), h, path + (xref,))
+            h.update(b'>')
+    if pdf.xref_is_stream(xref):
+        h.update(pdf.xref_stream_raw(xref))
+    return h.digest()
+
+
+def visit_pages(
+    pdf, text=True, images=True, skip_boilerplate=False, max_total_pages=None
+):
+    # Loads every page once and yields what both text and barcode
+    # extraction need from it. Consumers that stop early keep later pages
+    # from being loaded at all.
+    # With skip_boilerplate, pages between the end of a ticket's text and
+    # the start of the next ticket (terms of use, ads) are dropped. Every
+    # ticket starts on a page with its barcode image, so listing images is
+    # enough to skip most of them; the text is only needed for the rest.
+    ended = False
     for page in pdf:
-        for xref in page.get_images():
-            img_data = pdf.extract_image(xref[0])
-            arr = numpy.frombuffer(img_data['image'], numpy.uint8)
-            img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-            results = zxingcpp.read_barcodes(img, formats=BARCODE_FORMATS)
+        if max_total_pages is not None and page.number >= max_total_pages:
+            warnings.warn(
+                f'skipping pages after page {max_total_pages} '
+                f'of {pdf.page_count}'
+            )
+            break
+        blocks = []
+        xrefs = None
+        if images or ended:
+            with span('get_images', page=page.number):
+                xrefs = page.get_images(full=True)
+        if ended and not xrefs:
+            continue
+        if text or skip_boilerplate:
+            with span('get_text', page=page.number):
+                blocks = page.get_text('blocks')
+        if skip_boilerplate:
+            if starts_ticket(blocks):
+                ended = False
+            elif ended:
+                continue
+            ended = ends_ticket(blocks)
+        yield page, blocks, xrefs if images else []
+
+
+def extract_barcodes(
+    pdf,
+    limit=1,
+    max_pages=None,
+    decode='gray',
+    ladder=True,
+    pages=None,
+    filter_images=True,
+    memo=None,
+    threads=1,
+    max_image_pixels=MAX_IMAGE_PIXELS,
+    max_total_pixels=MAX_TOTAL_PIXELS,
+    usage=None,
+):
+    # DB tickets have their barcode at the top of the first page, so by
+    # default stop as soon as one is found. limit=None scans everything.
+    # Every distinct image is only used once, even if it is referenced
+    # from several pages or stored several times. memo can be shared
+    # between calls for the same document to not decode images again. It
+    # maps xrefs to image digests and digests to results.
+    # usage counts the decoded pixels against the budgets; like memo, it
+    # can be shared between calls for the same document.
+    if pages is None:
+        pages = visit_pages(pdf, text=False, max_total_pages=MAX_TOTAL_PAGES)
+    if memo is None:
+        memo = {}
+    budget = {
+        'max_image_pixels': max_image_pixels,
+        'max_total_pixels': max_total_pixels,
+        'used': collections.Counter() if usage is None else usage,
+    }
+
+    def candidates():
+        seen = set()
+        for page, _, images in itertools.islice(pages, max_pages):
+            if filter_images:
+                xrefs = barcode_candidates(page, images)
+            else:
+                xrefs = [item[0] for item in images]
+            items = {item[0]: item for item in images}
+            for xref in xrefs:
+                if xref not in memo:
+                    memo[xref] = image_digest(pdf, xref)
+                if memo[xref] not in seen:
+                    seen.add(memo[xref])
+                    yield page, items[xref], memo[xref]
+
+    barcodes = []
+    decoded = decode_images(
+        pdf, candidates(), decode, ladder, memo, threads, budget
+    )
+    with contextlib.closing(decoded):
+        for results in decoded:
             for result in results:
-                barcodes.append((result.bytes, BARCODES[result.format]))
+                _format = BARCODES[result.format.name]
+                barcodes.append((result.bytes, _format))
+            if limit and len(barcodes) >= limit:
+                return barcodes
     return barcodes
 
 
-def iter_lines(pdf):
+def iter_lines(pdf, pages=None):
+    if pages is None:
+        pages = visit_pages(pdf, images=False, max_total_pages=MAX_TOTAL_PAGES)
+
     last_x = 0
     last_y = 0
     line = []
-    for page in pdf:
-        for x, y, _, _, text, _, _ in page.get_text('blocks'):
+    for _, blocks, _ in pages:
+        for x, y, _, _, text, _, _ in blocks:
             text = text.rstrip('\n').replace(',\n', ', ')
             if x <= last_x or y > last_y:
                 if line:
@@ -99,26 +770,29 @@ def iter_lines(pdf):
         yield line
 
 
+@functools.lru_cache(maxsize=1024)
 def parse_leg_dt(datestr, timestr, prefix, start):
-    f = f'%d.%m.%Y {prefix} %H:%M'
-    dt = strptime(f'{datestr}{start.year} {timestr}', f)
+    # legs only have day and month, so take the first match after start
+    m = LEG_DATE_RE.fullmatch(f'{datestr} {timestr}')
+    if not m or m[3] != prefix:
+        raise ValueError(f'invalid leg date: {datestr!r} {timestr!r}')
+    day, month, _, hour, minute = m.groups()
+    dt = datetime.datetime(
+        start.year, int(month), int(day), int(hour), int(minute), tzinfo=TZ
+    )
     if dt < start:
-        dt = strptime(f'{datestr}{start.year + 1} {timestr}', f)
+        dt = dt.replace(year=start.year + 1)
     return dt
 
 
 def parse_validity(text):
     if 'bis' in text:
         s_start, s_end = text.split(' bis ')
-        try:
-            start = strptime(s_start, '%d.%m.%Y %H:%M Uhr')
-            end = strptime(s_end, '%d.%m.%Y %H:%M Uhr')
-        except ValueError:
-            start = strptime(s_start, '%d.%m.%Y')
-            end = strptime(s_end, '%d.%m.%Y')
+        start = parse_date(s_start)
+        end = parse_date(s_end)
     else:
         s_start = text.removeprefix('Fahrtantritt am ')
-        start = strptime(s_start, '%d.%m.%Y')
+        start = parse_date(s_start)
         end = start + datetime.timedelta(days=1)
     return start, end
 
@@ -182,8 +856,8 @@ def extract_leg(line, start):
     return leg
 
 
-def extract(pdf):
-    lines = iter_lines(pdf)
+def extract(pdf, pages=None):
+    lines = iter_lines(pdf, pages)
     header = extract_header(lines)
 
     legs = []
@@ -219,9 +893,7 @@ def format_legs(legs):
     return s
 
 
-def extract_content(pdf):
-    header, legs = extract(pdf)
-
+def build_pass(header, legs, barcodes):
     data = {
         'formatVersion': 1,
         'organizationName': 'Deutsche Bahn AG',
@@ -242,7 +914,7 @@ def extract_content(pdf):
                 'message': message.decode('iso-8859-1'),
                 'messageEncoding': 'iso-8859-1',
             }
-            for message, _format in extract_barcodes(pdf)
+            for message, _format in barcodes
         ],
         'boardingPass': {
             'transitType': 'PKTransitTypeTrain',
@@ -279,28 +951,1031 @@ def extract_content(pdf):
     return data
 
 
+def extract_content(
+    pdf, skip_boilerplate=True, max_total_pages=MAX_TOTAL_PAGES, **options
+):
+    # a single pass over the pages is shared by text and barcode extraction
+    usage = collections.Counter()
+    pages = visit_pages(
+        pdf,
+        skip_boilerplate=skip_boilerplate,
+        max_total_pages=max_total_pages,
+    )
+    text_pages, barcode_pages = itertools.tee(pages)
+    header, legs = extract(pdf, text_pages)
+    barcodes = extract_barcodes(
+        pdf, pages=barcode_pages, usage=usage, **options
+    )
+    BUDGET_STATS.update(usage)
+    with span('budget', **usage):
+        pass
+    return build_pass(header, legs, barcodes)
+
+
+def starts_ticket(blocks):
+    # A page with the header of a ticket: like extract_header, it needs
+    # the validity besides the order or BahnCard number, as footers and
+    # the like may repeat the number on every page.
+    numbered = valid = False
+    for _, _, _, _, text, _, _ in blocks:
+        if '\nAuftragsnummer: ' in text or '\nBahnCard-Nr.: ' in text:
+            numbered = True
+        if text.startswith(('Gültigkeit: ', 'Fahrtantritt am ')):
+            valid = True
+    return numbered and valid
+
+
+def ends_ticket(blocks):
+    # extract() stops reading at the same heading
+    return any(
+        text.startswith('Wichtige Nutzungshinweise')
+        for _, _, _, _, text, _, _ in blocks
+    )
+
+
+def split_tickets(pages):
+    # A page with a ticket header starts a new ticket, even with the same
+    # number (e.g. outward and return trip of one order). All other pages
+    # belong to the current ticket, so every ticket but the first starts
+    # with a header and extract_header cannot fail on it.
+    ticket = []
+    headed = False
+    for page in pages:
+        if starts_ticket(page[1]):
+            if headed:
+                yield ticket
+                ticket = []
+            headed = True
+        ticket.append(page)
+    if ticket:
+        yield ticket
+
+
+def extract_passes(
+    pdf, skip_boilerplate=True, max_total_pages=MAX_TOTAL_PAGES, **options
+):
+    # like extract_content, but with one pass per ticket in the document
+    passes = []
+    memo = {}
+    usage = collections.Counter()
+    pages = visit_pages(
+        pdf,
+        skip_boilerplate=skip_boilerplate,
+        max_total_pages=max_total_pages,
+    )
+    for ticket in split_tickets(pages):
+        header, legs = extract(pdf, iter(ticket))
+        barcodes = extract_barcodes(
+            pdf, pages=iter(ticket), memo=memo, usage=usage, **options
+        )
+        passes.append(build_pass(header, legs, barcodes))
+    BUDGET_STATS.update(usage)
+    with span('budget', **usage):
+        pass
+
+    serials = [data['serialNumber'] for data in passes]
+    if len(set(serials)) < len(serials):
+        # e.g. outward and return ticket of the same order
+        for i, data in enumerate(passes, 1):
+            data['serialNumber'] += f'-{i}'
+
+    return passes
+
+
+LEG_FIELDS = [
+    'file',
+    'ticket',
+    'id_label',
+    'id_value',
+    'leg',
+    'start_station',
+    'start_datetime',
+    'start_platform',
+    'destination_station',
+    'destination_datetime',
+    'destination_platform',
+    'train',
+    'comment',
+]
+
+
+def leg_records(header, legs):
+    # flat, JSON-compatible records with all of LEG_FIELDS but file and ticket
+    for i, leg in enumerate(legs, 1):
+        record = {
+            'id_label': header['id_label'],
+            'id_value': header['id_value'],
+            'leg': i,
+            'train': leg['train'],
+            'comment': leg.get('comment'),
+        }
+        for key in ['start', 'destination']:
+            stop = leg[key]
+            record[f'{key}_station'] = stop['station']
+            record[f'{key}_datetime'] = stop['datetime'].isoformat()
+            record[f'{key}_platform'] = stop.get('platform')
+        yield record
+
+
+def extract_itinerary(source):
+    # one record per leg of every ticket in the document; images are not
+    # even listed because no barcodes are needed
+    records = []
+    with open_pdf(source) as pdf:
+        pages = visit_pages(
+            pdf,
+            images=False,
+            skip_boilerplate=True,
+            max_total_pages=MAX_TOTAL_PAGES,
+        )
+        for i, ticket in enumerate(split_tickets(pages), 1):
+            header, legs = extract(pdf, iter(ticket))
+            for record in leg_records(header, legs):
+                record['ticket'] = i
+                records.append(record)
+    return records
+
+
+def cache_key(source, options):
+    # the number of decode threads does not change the result
+    options = {k: v for k, v in options.items() if k != 'threads'}
+    h = hashlib.sha256()
+    h.update(json.dumps([VERSION, options], sort_keys=True).encode('utf-8'))
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fh:
+            while chunk := fh.read(CHUNK_SIZE):
+                h.update(chunk)
+    else:
+        h.update(source)
+    return h.hexdigest()
+
+
+def cache_get(key, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, f'{key}.json')
+    try:
+        with open(path) as fh:
+            content = json.load(fh)
+    except FileNotFoundError:
+        CACHE_STATS['misses'] += 1
+        return None
+    # eviction is least recently used first; other processes may have
+    # evicted the entry since it was read
+    with contextlib.suppress(FileNotFoundError):
+        os.utime(path)
+    CACHE_STATS['hits'] += 1
+    return content
+
+
+def cache_put(
+    key, content, cache_dir=CACHE_DIR, evict_interval=CACHE_EVICT_INTERVAL
+):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{key}.json')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(content, fh)
+    os.replace(tmp_path, path)
+    CACHE_STATS['writes'] += 1
+    if evict_interval and CACHE_STATS['writes'] % evict_interval == 0:
+        cache_evict(cache_dir)
+
+
+def cache_evict(
+    cache_dir=CACHE_DIR, max_size=CACHE_MAX_SIZE, max_age=CACHE_MAX_AGE
+):
+    # worker processes evict concurrently, so entries may vanish any time
+    entries = []
+    try:
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith('.json'):
+                with contextlib.suppress(FileNotFoundError):
+                    entries.append((entry.path, entry.stat()))
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda entry: entry[1].st_mtime, reverse=True)
+
+    cutoff = datetime.datetime.now().timestamp() - max_age.total_seconds()
+    size = 0
+    for path, stat in entries:
+        size += stat.st_size
+        if stat.st_mtime < cutoff or size > max_size:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+                CACHE_STATS['evictions'] += 1
+
+
+def cache_clear(cache_dir=CACHE_DIR):
+    cache_evict(cache_dir, max_size=0)
+
+
+def open_pdf(source):
+    # source is a path or a buffer (bytes, bytearray, mmap, ...). Neither is
+    # copied: MuPDF reads files itself and works on a view of buffers.
+    import pymupdf
+
+    if isinstance(source, (str, os.PathLike)):
+        return pymupdf.open(source)
+    return pymupdf.open(stream=memoryview(source))
+
+
+def load_content(source, options, cache=True):
+    key = cache_key(source, options)
+    with span('cache_get', enabled=cache):
+        content = cache_get(key) if cache else None
+    if content is not None:
+        return content, True
+
+    with span('open'):
+        pdf = open_pdf(source)
+    # close explicitly so that callers can release their buffer (e.g. close
+    # an mmap) as soon as we return
+    with pdf, span('extract_passes', pages=pdf.page_count):
+        passes = extract_passes(pdf, **options)
+    content = passes[0] if len(passes) == 1 else passes
+    if cache:
+        cache_put(key, content)
+    return content, False
+
+
+def pass_files(content, identifiers=None):
+    # identifiers replace the placeholder pass type and team of build_pass
+    return {
+        'pass.json': json.dumps(content | (identifiers or {})).encode('utf-8'),
+        'icon.png': ICON,
+        'logo.png': ICON,
+    }
+
+
+def write_content(
+    fh, content, compression=COMPRESSION, sign=None, identifiers=None
+):
+    # content is a single pass or a list of passes for a .pkpasses bundle
+    if isinstance(content, list):
+        bundle = [pass_files(data, identifiers) for data in content]
+        write_pkpasses(fh, bundle, compression, sign)
+    else:
+        write_pkpass(fh, pass_files(content, identifiers), compression, sign)
+
+
+def convert(
+    path,
+    debug=False,
+    options=None,
+    cache=True,
+    compression=COMPRESSION,
+    trace=False,
+    signer=None,
+    repack=False,
+    output_dir=None,
+):
+    # signer is a tuple of load_signer() arguments, so it can be passed to
+    # worker processes
+    if trace:
+        with profile() as events:
+            result = convert(
+                path,
+                debug,
+                options,
+                cache,
+                compression,
+                signer=signer,
+                repack=repack,
+                output_dir=output_dir,
+            )
+        write_trace(events, os.path.splitext(path)[0] + '.trace.json')
+        return result
+
+    options = options or {}
+    cached = False
+    if path.endswith('.json'):
+        with open(path) as fh:
+            content = json.load(fh)
+    else:
+        content, cached = load_content(path, options, cache)
+
+    if debug:
+        return json.dumps(content, indent=2), cached
+    else:
+        ext = '.pkpasses' if isinstance(content, list) else '.pkpass'
+        output_path = os.path.splitext(path)[0] + ext
+        if output_dir:
+            output_path = os.path.join(
+                output_dir, os.path.basename(output_path)
+            )
+        sign = load_signer(*signer) if signer else None
+        identifiers = load_identifiers(signer[0]) if signer else None
+        t0 = time.perf_counter()
+        tmp_path = f'{output_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fh:
+            if repack and ext == '.pkpass' and os.path.exists(output_path):
+                pass_json = pass_files(content, identifiers)['pass.json']
+                files = {'pass.json': pass_json}
+                repack_pkpass(output_path, fh, files, compression, sign)
+            else:
+                write_content(fh, content, compression, sign, identifiers)
+            size = fh.tell()
+        os.replace(tmp_path, output_path)
+        ms = (time.perf_counter() - t0) * 1000
+        return f'written to {output_path} ({size} bytes, {ms:.1f} ms)', cached
+
+
+def iter_paths(patterns):
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            yield from sorted(glob.glob(os.path.join(pattern, '*.pdf')))
+        elif glob.has_magic(pattern):
+            yield from sorted(glob.glob(pattern))
+        else:
+            yield pattern
+
+
+def _try(fn, *args, **kwargs):
+    try:
+        return fn(*args, **kwargs), None
+    except Exception as err:
+        return None, f'{type(err).__name__}: {err}'
+
+
+def _result(future):
+    # like future.result() of _try, but a worker that died (segfault, OOM
+    # kill) raises BrokenProcessPool for everything that was in flight
+    try:
+        return future.result()
+    except concurrent.futures.BrokenExecutor as err:
+        return None, f'{type(err).__name__}: {err}'
+
+
+def imap(fn, items, *args, jobs=None, **kwargs):
+    # yields (item, result, error) in input order; at most 2 * jobs
+    # items are in flight so the input may be an arbitrarily long iterator.
+    # If a worker dies, the items in flight fail and the pool is replaced.
+    if jobs == 1:
+        for item in items:
+            yield item, *_try(fn, item, *args, **kwargs)
+        return
+
+    jobs = jobs or os.cpu_count()
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+    try:
+        pending = collections.deque()
+        for item in items:
+            try:
+                future = executor.submit(_try, fn, item, *args, **kwargs)
+            except concurrent.futures.BrokenExecutor:
+                executor.shutdown()
+                executor = concurrent.futures.ProcessPoolExecutor(jobs)
+                future = executor.submit(_try, fn, item, *args, **kwargs)
+            pending.append((item, future))
+            if len(pending) >= 2 * jobs:
+                item, future = pending.popleft()
+                yield item, *_result(future)
+        while pending:
+            item, future = pending.popleft()
+            yield item, *_result(future)
+    finally:
+        executor.shutdown()
+
+
+def export_legs(paths, fh, fmt='jsonl', jobs=None):
+    # Writes the records of each file as soon as it is extracted, so memory
+    # does not grow with the number of paths. Yields (path, number of legs,
+    # error) for each path.
+    if fmt == 'csv':
+        writer = csv.DictWriter(fh, LEG_FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(record):
+            fh.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    for path, records, err in imap(extract_itinerary, paths, jobs=jobs):
+        for record in records or []:
+            write({field: record.get(field) for field in LEG_FIELDS} | {
+                'file': path,
+            })
+        yield path, len(records or []), err
+
+
+def _inotify(path):
+    # Returns a non-blocking inotify fd that becomes readable when a file
+    # in path was written or moved there, or None if inotify is not
+    # available on this system.
+    import ctypes
+    import ctypes.util
+
+    in_close_write = 0x08
+    in_moved_to = 0x80
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = in_close_write | in_moved_to
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _warm_up():
+    # Ctrl-C is meant for the main process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # import the extraction libraries once per worker instead of per file
+    import cv2  # noqa: F401
+    import numpy  # noqa: F401
+    import pymupdf  # noqa: F401
+    import zxingcpp  # noqa: F401
+
+
+def _move(path, directory):
+    # unlike os.replace, also works across file systems
+    os.makedirs(directory, exist_ok=True)
+    shutil.move(path, os.path.join(directory, os.path.basename(path)))
+
+
+def watch(
+    spool,
+    output_dir,
+    error_dir,
+    jobs=None,
+    interval=10,
+    settle=1,
+    stop=None,
+    **kwargs,
+):
+    # Converts every PDF that appears in spool. Results and processed PDFs
+    # are moved to output_dir, failed PDFs to error_dir along with a
+    # <name>.error.txt. A file is only picked up once its size and mtime
+    # have not changed for settle seconds, so partially written files are
+    # left alone. inotify wakes the loop up early, otherwise the directory
+    # is polled every interval seconds. Runs until stop is set, then waits
+    # for running conversions.
+    jobs = jobs or os.cpu_count()
+    stop = stop or threading.Event()
+    fd = _inotify(spool)
+    os.makedirs(output_dir, exist_ok=True)
+    seen = {}
+    running = {}
+
+    def submit(path):
+        return executor.submit(
+            _try, convert, path, output_dir=output_dir, **kwargs
+        )
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=_warm_up
+    )
+    try:
+        while not stop.is_set() or running:
+            now = time.monotonic()
+            candidates = {}
+            for entry in os.scandir(spool) if not stop.is_set() else []:
+                if (
+                    entry.name.endswith('.pdf')
+                    and entry.is_file()
+                    and entry.path not in running
+                ):
+                    try:
+                        stat = entry.stat()
+                    except OSError as err:
+                        # e.g. removed in the meantime
+                        print(f'{entry.path}: {err}', file=sys.stderr)
+                        continue
+                    state = (stat.st_size, stat.st_mtime)
+                    old_state, since = seen.get(entry.path, (None, now))
+                    candidates[entry.path] = (
+                        state, since if state == old_state else now
+                    )
+            seen = candidates
+
+            for path, (_, since) in seen.items():
+                if len(running) >= 2 * jobs:
+                    break
+                if since <= now - settle:
+                    try:
+                        running[path] = submit(path)
+                    except concurrent.futures.BrokenExecutor:
+                        # A worker died. The files that were in flight fail
+                        # below instead of being retried forever.
+                        executor.shutdown()
+                        executor = concurrent.futures.ProcessPoolExecutor(
+                            jobs, initializer=_warm_up
+                        )
+                        running[path] = submit(path)
+
+            for path, future in list(running.items()):
+                if not future.done():
+                    continue
+                del running[path]
+                seen.pop(path, None)
+                result, err = _result(future)
+                try:
+                    if err:
+                        print(f'{path}: {err}', file=sys.stderr)
+                        error_path = os.path.join(
+                            error_dir,
+                            os.path.basename(path).removesuffix('.pdf'),
+                        )
+                        _move(path, error_dir)
+                        with open(f'{error_path}.error.txt', 'w') as fh:
+                            fh.write(f'{err}\n')
+                    else:
+                        print(f'{path}: {result[0]}')
+                        _move(path, output_dir)
+                except OSError as err:
+                    # e.g. removed in the meantime, a single file must not
+                    # end the loop
+                    print(f'{path}: {err}', file=sys.stderr)
+
+            if running:
+                timeout = 0.1
+            elif seen:
+                timeout = settle
+            else:
+                timeout = interval
+            if fd is None:
+                stop.wait(timeout)
+            # inotify covers new files, but stop still needs to be checked
+            elif select.select([fd], [], [], min(timeout, 1))[0]:
+                # the events themselves do not matter, the scan finds
+                # everything
+                while True:
+                    try:
+                        os.read(fd, 4096)
+                    except BlockingIOError:
+                        break
+    finally:
+        executor.shutdown()
+        if fd is not None:
+            os.close(fd)
+
+
+class _WriterIO(io.RawIOBase):
+    # lets zipfile write into an asyncio.StreamWriter
+    def __init__(self, writer):
+        self.writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.writer.write(bytes(b))
+        return len(b)
+
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    413: 'Content Too Large',
+    422: 'Unprocessable Content',
+    503: 'Service Unavailable',
+}
+MAX_UPLOAD_SIZE = 32 * 1024 * 1024
+# seconds to send the headers and then the body of a request, and to
+# finish running requests on shutdown
+REQUEST_TIMEOUT = 30
+SHUTDOWN_TIMEOUT = 30
+
+
+def _write_head(writer, status, content_type='text/plain; charset=utf-8'):
+    writer.write((
+        f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        'Connection: close\r\n'
+        '\r\n'
+    ).encode('ascii'))
+
+
+async def _read_head(reader):
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        key, value = line.decode('latin-1').split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length < 0:
+        raise ValueError(f'invalid Content-Length: {length}')
+    return method, target, length
+
+
+async def _handle(reader, writer, executor, slots, options, cache, write):
+    import asyncio
+
+    # Idle clients must neither hold a slot nor keep the service from
+    # shutting down, so the request is read with a timeout before a slot
+    # is taken.
+    try:
+        method, target, length = await asyncio.wait_for(
+            _read_head(reader), REQUEST_TIMEOUT
+        )
+    except ValueError:
+        _write_head(writer, 400)
+        return
+    except asyncio.TimeoutError:
+        _write_head(writer, 408)
+        return
+    if method != 'POST':
+        _write_head(writer, 405)
+        return
+    if length > MAX_UPLOAD_SIZE:
+        _write_head(writer, 413)
+        return
+    try:
+        data = await asyncio.wait_for(
+            reader.readexactly(length), REQUEST_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        _write_head(writer, 408)
+        return
+    if slots.locked():
+        # shed load instead of queueing requests without bounds
+        _write_head(writer, 503)
+        return
+
+    async with slots:
+        loop = asyncio.get_running_loop()
+        try:
+            content, _ = await loop.run_in_executor(
+                executor, load_content, data, options, cache
+            )
+        except Exception as err:
+            _write_head(writer, 422)
+            writer.write(f'{type(err).__name__}: {err}\n'.encode('utf-8'))
+            return
+
+    if target.endswith('?debug'):
+        _write_head(writer, 200, 'application/json')
+        writer.write(json.dumps(content, indent=2).encode('utf-8'))
+    else:
+        if isinstance(content, list):
+            _write_head(writer, 200, 'application/vnd.apple.pkpasses')
+        else:
+            _write_head(writer, 200, 'application/vnd.apple.pkpass')
+        write(_WriterIO(writer), content)
+
+
+async def start_service(
+    host,
+    port,
+    executor,
+    max_pending,
+    options=None,
+    cache=True,
+    compression=COMPRESSION,
+    signer=None,
+):
+    import asyncio
+
+    # POST a PDF to / to get the pkpass, or to /?debug to get the JSON.
+    # At most max_pending requests are processed or queued for the
+    # executor at a time, all others are rejected with 503.
+    slots = asyncio.Semaphore(max_pending)
+    tasks = set()
+    write = functools.partial(
+        write_content,
+        compression=compression,
+        sign=load_signer(*signer) if signer else None,
+        identifiers=load_identifiers(signer[0]) if signer else None,
+    )
+
+    async def handle(reader, writer):
+        tasks.add(asyncio.current_task())
+        try:
+            await _handle(
+                reader,
+                writer,
+                executor,
+                slots,
+                options or {},
+                cache,
+                write,
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # cancelled by serve() on shutdown; asyncio logs the traceback
+            # of connection handlers that end with an exception
+            pass
+        finally:
+            writer.close()
+            tasks.discard(asyncio.current_task())
+
+    server = await asyncio.start_server(handle, host, port)
+    return server, tasks
+
+
+async def serve(host, port, jobs=None, max_pending=None, **kwargs):
+    import asyncio
+    import multiprocessing
+
+    jobs = jobs or os.cpu_count()
+    # forking from a running event loop can leave workers deadlocked
+    mp_context = multiprocessing.get_context('forkserver')
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context) as executor:
+        server, tasks = await start_service(
+            host, port, executor, max_pending or 2 * jobs, **kwargs
+        )
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stop.set)
+
+        addr = server.sockets[0].getsockname()
+        print(f'listening on {addr[0]}:{addr[1]}', file=sys.stderr)
+        await stop.wait()
+
+        # stop accepting, then let running conversions finish. Since
+        # Python 3.12, wait_closed() also waits for all connections.
+        server.close()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        await server.wait_closed()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('path')
+    parser.add_argument(
+        'paths',
+        nargs='*',
+        metavar='path',
+        help='PDF or JSON file, directory of PDFs, or glob pattern',
+    )
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        help='number of worker processes (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '--barcodes',
+        type=int,
+        default=1,
+        help='stop after this many barcodes were found (0: scan all images)',
+    )
+    parser.add_argument(
+        '--barcode-pages',
+        type=int,
+        help='only scan the first N pages for barcodes',
+    )
+    parser.add_argument(
+        '--decode',
+        choices=['gray', 'color'],
+        default='gray',
+        help='image mode used for barcode detection',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='neither read nor write the conversion cache',
+    )
+    parser.add_argument(
+        '--clear-cache',
+        action='store_true',
+        help=f'remove all entries from the conversion cache ({CACHE_DIR})',
+    )
+    parser.add_argument(
+        '--compress-level',
+        type=int,
+        choices=range(10),
+        default=COMPRESSION['.json'][1],
+        metavar='0-9',
+        help='deflate level for JSON entries (0: store uncompressed)',
+    )
+    parser.add_argument(
+        '--serve',
+        metavar='[HOST:]PORT',
+        help='run an HTTP conversion service instead of converting files',
+    )
+    parser.add_argument(
+        '--max-pending',
+        type=int,
+        help='requests accepted by the service before it responds with 503 '
+        '(default: 2 * jobs)',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='write a Chrome trace of each conversion to <path>.trace.json',
+    )
+    parser.add_argument(
+        '--no-ladder',
+        dest='ladder',
+        action='store_false',
+        help='only decode images at native resolution',
+    )
+    parser.add_argument(
+        '--all-pages',
+        dest='skip_boilerplate',
+        action='store_false',
+        help='also scan pages after the terms of use for barcodes',
+    )
+    parser.add_argument(
+        '--all-images',
+        dest='filter_images',
+        action='store_false',
+        help='also decode images that are too small or too narrow to be '
+        'barcodes',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=1,
+        help='decode the images of one PDF in this many threads',
+    )
+    parser.add_argument(
+        '--max-image-pixels',
+        type=int,
+        default=MAX_IMAGE_PIXELS,
+        help='decode larger images at reduced scale or skip them '
+        '(0: unlimited, default: %(default)s)',
+    )
+    parser.add_argument(
+        '--max-total-pixels',
+        type=int,
+        default=MAX_TOTAL_PIXELS,
+        help='skip images once this many pixels were decoded for a PDF '
+        '(0: unlimited, default: %(default)s)',
+    )
+    parser.add_argument(
+        '--max-total-pages',
+        type=int,
+        default=MAX_TOTAL_PAGES,
+        help='ignore pages after this one (0: unlimited, default: '
+        '%(default)s)',
+    )
+    parser.add_argument(
+        '--cert',
+        help='PEM pass type certificate to sign passes with (needs the '
+        'cryptography package)',
+    )
+    parser.add_argument(
+        '--key',
+        help='PEM private key of --cert; a password can be given in '
+        '$PKPASS_KEY_PASSWORD',
+    )
+    parser.add_argument(
+        '--wwdr',
+        help='PEM Apple WWDR intermediate certificate to include',
+    )
+    parser.add_argument(
+        '--repack',
+        action='store_true',
+        help='only replace pass.json in an existing .pkpass output file',
+    )
+    parser.add_argument(
+        '--export',
+        choices=['jsonl', 'csv'],
+        help='write one record per leg of all tickets to stdout instead of '
+        'converting them',
+    )
+    parser.add_argument(
+        '--watch',
+        metavar='SPOOL',
+        help='keep converting PDFs that appear in this directory',
+    )
+    parser.add_argument(
+        '-o',
+        '--output-dir',
+        help='directory for output files (default: next to the input; '
+        'with --watch: SPOOL/done)',
+    )
+    parser.add_argument(
+        '--error-dir',
+        help='directory for PDFs that failed with --watch '
+        '(default: SPOOL/failed)',
+    )
     args = parser.parse_args()
 
-    if args.path.endswith('.json'):
-        with open(args.path) as fh:
-            content = json.load(fh)
-    else:
-        with open(args.path, 'rb') as fh:
-            pdf = pymupdf.open(stream=fh.read())
-        content = extract_content(pdf)
+    if bool(args.cert) != bool(args.key):
+        parser.error('--cert and --key must be used together')
 
-    if args.debug:
-        print(json.dumps(content, indent=2))
-    else:
-        output_path = os.path.splitext(args.path)[0] + '.pkpass'
-        with open(output_path, 'wb') as fh:
-            fh.write(dump_pkpass({
-                'pass.json': json.dumps(content).encode('utf-8'),
-                'icon.png': ICON,
-                'logo.png': ICON,
-            }))
-        print(f'written to {output_path}')
+    if args.clear_cache:
+        cache_clear()
+    elif not args.paths and not args.serve and not args.watch:
+        parser.error('the following arguments are required: path')
+
+    options = {
+        'limit': args.barcodes,
+        'max_pages': args.barcode_pages,
+        'decode': args.decode,
+        'ladder': args.ladder,
+        'skip_boilerplate': args.skip_boilerplate,
+        'filter_images': args.filter_images,
+        'threads': args.threads,
+        'max_image_pixels': args.max_image_pixels or None,
+        'max_total_pixels': args.max_total_pixels or None,
+        'max_total_pages': args.max_total_pages or None,
+    }
+    compression = COMPRESSION | {
+        '.json': (
+            (zipfile.ZIP_DEFLATED, args.compress_level)
+            if args.compress_level
+            else (zipfile.ZIP_STORED, None)
+        ),
+    }
+    signer = None
+    if args.cert:
+        password = os.environ.get('PKPASS_KEY_PASSWORD')
+        signer = (
+            args.cert,
+            args.key,
+            args.wwdr,
+            password.encode('utf-8') if password else None,
+        )
+
+    if args.serve:
+        import asyncio
+
+        host, _, port = args.serve.rpartition(':')
+        asyncio.run(serve(
+            host or 'localhost',
+            int(port),
+            jobs=args.jobs,
+            max_pending=args.max_pending,
+            options=options,
+            cache=not args.no_cache,
+            compression=compression,
+            signer=signer,
+        ))
+        sys.exit()
+
+    if args.watch:
+        stop = threading.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(sig, lambda *_: stop.set())
+        watch(
+            args.watch,
+            args.output_dir or os.path.join(args.watch, 'done'),
+            args.error_dir or os.path.join(args.watch, 'failed'),
+            jobs=args.jobs,
+            stop=stop,
+            options=options,
+            cache=not args.no_cache,
+            compression=compression,
+            signer=signer,
+        )
+        sys.exit()
+
+    if args.export:
+        files = 0
+        failed = 0
+        for path, legs, err in export_legs(
+            iter_paths(args.paths), sys.stdout, args.export, jobs=args.jobs
+        ):
+            files += 1
+            if err:
+                failed += 1
+                print(f'{path}: {err}', file=sys.stderr)
+        print(
+            f'{files - failed} exported, {failed} failed', file=sys.stderr
+        )
+        sys.exit(1 if failed else 0)
+
+    paths = list(iter_paths(args.paths))
+    jobs = 1 if len(paths) == 1 else args.jobs
+
+    failed = 0
+    hits = 0
+    for path, result, err in imap(
+        convert,
+        paths,
+        jobs=jobs,
+        debug=args.debug,
+        options=options,
+        cache=not args.no_cache,
+        compression=compression,
+        trace=args.profile,
+        signer=signer,
+        repack=args.repack,
+        output_dir=args.output_dir,
+    ):
+        if err:
+            failed += 1
+            print(f'{path}: {err}', file=sys.stderr)
+            continue
+        msg, cached = result
+        hits += cached
+        if len(paths) == 1 or args.debug:
+            print(msg)
+        else:
+            print(f'{path}: {msg}')
+
+    if not args.no_cache:
+        cache_evict()
+    if len(paths) > 1:
+        print(
+            f'{len(paths) - failed} converted, {failed} failed, '
+            f'{hits} from cache',
+            file=sys.stderr,
+        )
+    if failed:
+        sys.exit(1)
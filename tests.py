@@ -1,5 +1,24 @@
+import asyncio
+import collections
+import concurrent.futures
+import csv
+import errno
 import unittest
+import unittest.mock
 import datetime
+import glob
+import hashlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
 from zoneinfo import ZoneInfo
 
 import pymupdf
@@ -8,6 +27,10 @@ import db_pkpass
 
 TZ = ZoneInfo(key='Europe/Berlin')
 
+# DB_PKPASS_PERF=1 compares against perf_baseline.json, =update rewrites it
+PERF = os.environ.get('DB_PKPASS_PERF')
+PERF_BASELINE = os.path.join(os.path.dirname(__file__), 'perf_baseline.json')
+
 
 class ExtractLegsTests(unittest.TestCase):
     maxDiff = None
@@ -656,3 +679,1192 @@ class ExtractLegsTests(unittest.TestCase):
                 'train': 'RE 74 (21225)',
             },
         ])
+
+
+class ParseDateTests(unittest.TestCase):
+    def test_date(self):
+        self.assertEqual(
+            db_pkpass.parse_date('22.04.2022'),
+            datetime.datetime(2022, 4, 22, tzinfo=TZ),
+        )
+
+    def test_datetime(self):
+        self.assertEqual(
+            db_pkpass.parse_date('22.04.2022 09:05 Uhr'),
+            datetime.datetime(2022, 4, 22, 9, 5, tzinfo=TZ),
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            db_pkpass.parse_date('2022-04-22')
+
+    def test_leg_year_rollover(self):
+        start = datetime.datetime(2022, 12, 31, tzinfo=TZ)
+        self.assertEqual(
+            db_pkpass.parse_leg_dt('01.01.', 'an 00:15', 'an', start),
+            datetime.datetime(2023, 1, 1, 0, 15, tzinfo=TZ),
+        )
+
+    def test_leg_prefix(self):
+        start = datetime.datetime(2022, 4, 22, tzinfo=TZ)
+        with self.assertRaises(ValueError):
+            db_pkpass.parse_leg_dt('22.04.', 'an 10:00', 'ab', start)
+
+
+class SignTests(unittest.TestCase):
+    def setUp(self):
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import ec
+        except ImportError:
+            self.skipTest('cryptography is not installed')
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        key = ec.generate_private_key(ec.SECP256R1())
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def write_cert(path, *attributes):
+            name = x509.Name([
+                x509.NameAttribute(x509.NameOID.COMMON_NAME, 'db-pkpass test'),
+                *(x509.NameAttribute(*attribute) for attribute in attributes),
+            ])
+            cert = (
+                x509.CertificateBuilder()
+                .subject_name(name)
+                .issuer_name(name)
+                .public_key(key.public_key())
+                .serial_number(1)
+                .not_valid_before(now)
+                .not_valid_after(now + datetime.timedelta(days=1))
+                .sign(key, hashes.SHA256())
+            )
+            with open(path, 'wb') as fh:
+                fh.write(cert.public_bytes(serialization.Encoding.PEM))
+            return cert
+
+        self.cert_path = os.path.join(tmp.name, 'cert.pem')
+        self.cert = write_cert(
+            self.cert_path,
+            (x509.NameOID.USER_ID, 'pass.org.example.ticket'),
+            (x509.NameOID.ORGANIZATIONAL_UNIT_NAME, 'ABCDE12345'),
+        )
+        self.other_cert_path = os.path.join(tmp.name, 'other.pem')
+        write_cert(self.other_cert_path)
+        self.key_path = os.path.join(tmp.name, 'key.pem')
+        with open(self.key_path, 'wb') as fh:
+            fh.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ))
+
+    def test_signature(self):
+        from cryptography.hazmat.primitives.serialization import pkcs7
+
+        sign = db_pkpass.load_signer(self.cert_path, self.key_path)
+        self.assertIs(sign, db_pkpass.load_signer(self.cert_path, self.key_path))
+
+        data = db_pkpass.dump_pkpass({'pass.json': b'{}'}, sign=sign)
+        with zipfile.ZipFile(io.BytesIO(data)) as zfh:
+            signature = zfh.read('signature')
+        certs = pkcs7.load_der_pkcs7_certificates(signature)
+        self.assertEqual(certs, [self.cert])
+
+    def test_identifiers(self):
+        identifiers = db_pkpass.load_identifiers(self.cert_path)
+        self.assertEqual(identifiers, {
+            'passTypeIdentifier': 'pass.org.example.ticket',
+            'teamIdentifier': 'ABCDE12345',
+        })
+        content = {'passTypeIdentifier': 'ticket.ce9e.org', 'serialNumber': '1'}
+        buf = io.BytesIO()
+        db_pkpass.write_content(buf, [content] * 2, identifiers=identifiers)
+        with zipfile.ZipFile(buf) as zfh:
+            inner = zipfile.ZipFile(io.BytesIO(zfh.read('2.pkpass')))
+            data = json.loads(inner.read('pass.json'))
+        self.assertEqual(data, {'serialNumber': '1', **identifiers})
+
+        with self.assertRaisesRegex(ValueError, 'no UID'):
+            db_pkpass.load_identifiers(self.other_cert_path)
+
+
+class SplitTicketsTests(unittest.TestCase):
+    def block(self, text):
+        return (0, 0, 0, 0, text, 0, 0)
+
+    def header(self, number):
+        return [
+            self.block(f'Ticket\nAuftragsnummer: {number}'),
+            self.block('Gültigkeit: 22.04.2022'),
+        ]
+
+    def test_split(self):
+        pages = [
+            (0, self.header(1), []),
+            (1, [self.block('Wichtige Nutzungshinweise')], []),
+            (2, self.header(2), []),
+        ]
+        tickets = list(db_pkpass.split_tickets(pages))
+        self.assertEqual([[p[0] for p in t] for t in tickets], [[0, 1], [2]])
+
+    def test_repeated_number(self):
+        # footers with the number, or a number without a header, do not
+        # start a ticket, but a header with the same number does
+        pages = [
+            (0, [self.block('Deckblatt')], []),
+            (1, self.header(1), []),
+            (2, [self.block('Seite 2\nAuftragsnummer: 1')], []),
+            (3, self.header(1), []),
+            (4, [self.block('Seite 4\nAuftragsnummer: 2')], []),
+            (5, self.header(2), []),
+        ]
+        tickets = list(db_pkpass.split_tickets(pages))
+        self.assertEqual(
+            [[p[0] for p in t] for t in tickets], [[0, 1, 2], [3, 4], [5]]
+        )
+
+    def test_return_trip(self):
+        import bench
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        pdf = pymupdf.open()
+        for legs in [2, 3]:
+            path = os.path.join(tmp.name, f'{legs}.pdf')
+            bench.generate_ticket(path, legs=legs)
+            pdf.insert_pdf(pymupdf.open(path))
+
+        passes = db_pkpass.extract_passes(pdf)
+        self.assertEqual(
+            [data['serialNumber'] for data in passes],
+            ['123456789-1', '123456789-2'],
+        )
+        for data, legs in zip(passes, [2, 3]):
+            fields = data['boardingPass']['secondaryFields']
+            self.assertEqual(fields[1]['value'].count('ICE'), legs)
+            self.assertEqual(len(data['barcodes']), 1)
+
+    def test_footer(self):
+        import bench
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'ticket.pdf')
+        bench.generate_ticket(path, legs=24)
+        pdf = pymupdf.open(path)
+        # below the terms of use, so it is not read as a leg
+        self.assertEqual(pdf.page_count, 3)
+        pdf[2].insert_text((40, 800), 'Seite 3\nAuftragsnummer: 123456789')
+
+        passes = db_pkpass.extract_passes(pdf)
+        self.assertEqual(len(passes), 1)
+        self.assertEqual(passes[0]['serialNumber'], '123456789')
+        legs = passes[0]['boardingPass']['secondaryFields'][1]['value']
+        self.assertEqual(legs.count('ICE'), 24)
+
+    def test_skip_boilerplate(self):
+        pix = pymupdf.Pixmap(pymupdf.csGRAY, pymupdf.IRect(0, 0, 8, 8))
+        png = pix.tobytes('png')
+        pdf = pymupdf.open()
+        for text, image in [
+            ('Ticket\nAuftragsnummer: 1\n\nWichtige Nutzungshinweise', True),
+            ('Hinweise', False),
+            ('Werbung', True),
+            ('Ticket\nAuftragsnummer: 2', True),
+            ('Wichtige Nutzungshinweise', False),
+        ]:
+            page = pdf.new_page()
+            page.insert_text((40, 40), text)
+            if 'Auftragsnummer' in text:
+                page.insert_text((40, 200), 'Gültigkeit: 22.04.2022')
+            if image:
+                page.insert_image(pymupdf.Rect(300, 20, 340, 60), stream=png)
+
+        pages = db_pkpass.visit_pages(pdf, skip_boilerplate=True)
+        self.assertEqual([page.number for page, _, _ in pages], [0, 3, 4])
+        pages = db_pkpass.visit_pages(pdf)
+        self.assertEqual([page.number for page, _, _ in pages], [0, 1, 2, 3, 4])
+
+
+class BarcodeCandidatesTests(unittest.TestCase):
+    def image(self, page, width, height, rect):
+        pix = pymupdf.Pixmap(pymupdf.csGRAY, pymupdf.IRect(0, 0, width, height))
+        return page.insert_image(rect, stream=pix.tobytes('png'))
+
+    def test_candidates(self):
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        wide = self.image(page, 300, 100, pymupdf.Rect(40, 20, 340, 120))
+        self.image(page, 10, 10, pymupdf.Rect(40, 200, 140, 300))
+        self.image(page, 1000, 4, pymupdf.Rect(40, 400, 540, 402))
+        self.image(page, 50, 50, pymupdf.Rect(40, 500, 60, 520))
+        square = self.image(page, 100, 100, pymupdf.Rect(40, 600, 140, 700))
+
+        db_pkpass.SKIP_STATS.clear()
+        xrefs = db_pkpass.barcode_candidates(page, page.get_images(full=True))
+        self.assertEqual(xrefs, [square, wide])
+        self.assertEqual(db_pkpass.SKIP_STATS, {
+            'too small': 1,
+            'too narrow': 1,
+            'too small on page': 1,
+        })
+
+    def test_compact_aztec(self):
+        # one pixel per module, so only the size on the page makes it
+        # readable
+        import cv2
+        import numpy
+        import zxingcpp
+
+        barcode = zxingcpp.create_barcode('ticket', zxingcpp.BarcodeFormat.Aztec)
+        img = numpy.array(barcode.to_image(scale=1))
+        self.assertEqual(img.shape, (15, 15))
+        _, png = cv2.imencode('.png', img)
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        page.insert_image(pymupdf.Rect(40, 40, 200, 200), stream=png.tobytes())
+
+        db_pkpass.SKIP_STATS.clear()
+        barcodes = db_pkpass.extract_barcodes(pdf)
+        self.assertEqual(barcodes, [(b'ticket', 'PKBarcodeFormatAztec')])
+        self.assertEqual(db_pkpass.SKIP_STATS, {})
+
+
+class ReadBarcodesTests(unittest.TestCase):
+    def img_data(self, ext, params=()):
+        import cv2
+        import numpy
+        import zxingcpp
+
+        barcode = zxingcpp.create_barcode('ticket', zxingcpp.BarcodeFormat.Aztec)
+        img = numpy.array(barcode.to_image(scale=4))
+        _, data = cv2.imencode(ext, img, params)
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        xref = page.insert_image(
+            pymupdf.Rect(40, 40, 200, 200), stream=data.tobytes()
+        )
+        return pdf.extract_image(xref)
+
+    def read(self, img_data, decode):
+        import zxingcpp
+
+        with unittest.mock.patch.object(
+            zxingcpp, 'read_barcodes', wraps=zxingcpp.read_barcodes
+        ) as read_barcodes:
+            results = db_pkpass.read_barcodes(img_data, decode)
+        self.assertEqual([result.bytes for result in results], [b'ticket'])
+        (img,), kwargs = read_barcodes.call_args
+        return img.ndim, kwargs.get('binarizer')
+
+    def test_gray(self):
+        img_data = self.img_data('.jpg')
+        self.assertEqual(img_data['bpc'], 8)
+        self.assertEqual(self.read(img_data, 'gray'), (2, None))
+
+    def test_bilevel(self):
+        import cv2
+        import zxingcpp
+
+        img_data = self.img_data('.png', [cv2.IMWRITE_PNG_BILEVEL, 1])
+        self.assertEqual(img_data['bpc'], 1)
+        self.assertEqual(
+            self.read(img_data, 'gray'), (2, zxingcpp.Binarizer.BoolCast)
+        )
+
+    def test_color(self):
+        self.assertEqual(self.read(self.img_data('.png'), 'color'), (3, None))
+
+
+class ExtractBarcodesTests(unittest.TestCase):
+    def aztec_pdf(self, *messages):
+        # one page with an Aztec code per message
+        import cv2
+        import numpy
+        import zxingcpp
+
+        pdf = pymupdf.open()
+        for message in messages:
+            barcode = zxingcpp.create_barcode(
+                message, zxingcpp.BarcodeFormat.Aztec
+            )
+            _, png = cv2.imencode('.png', numpy.array(barcode.to_image(scale=4)))
+            page = pdf.new_page()
+            page.insert_image(pymupdf.Rect(40, 40, 200, 200), stream=png.tobytes())
+        return pdf
+
+    def test_limit(self):
+        pdf = self.aztec_pdf('ticket 1', 'ticket 2')
+        db_pkpass.DECODE_STATS.clear()
+        barcodes = db_pkpass.extract_barcodes(pdf)
+        self.assertEqual(barcodes, [(b'ticket 1', 'PKBarcodeFormatAztec')])
+        self.assertEqual(db_pkpass.DECODE_STATS, {'native': 1})
+        self.assertEqual(len(db_pkpass.extract_barcodes(pdf, limit=0)), 2)
+
+    def test_max_pages(self):
+        pdf = self.aztec_pdf('ticket 1', 'ticket 2')
+        barcodes = db_pkpass.extract_barcodes(pdf, limit=0, max_pages=1)
+        self.assertEqual(barcodes, [(b'ticket 1', 'PKBarcodeFormatAztec')])
+
+    def test_duplicate_images(self):
+        import cv2
+        import numpy
+        import zxingcpp
+
+        barcode = zxingcpp.create_barcode('ticket', zxingcpp.BarcodeFormat.Aztec)
+        _, png = cv2.imencode('.png', numpy.array(barcode.to_image(scale=4)))
+
+        # the same image object on two pages and a copy under another xref
+        pdf = pymupdf.open()
+        for _ in range(2):
+            doc = pymupdf.open()
+            for _ in range(2):
+                page = doc.new_page()
+                rect = pymupdf.Rect(40, 40, 200, 200)
+                page.insert_image(rect, stream=png.tobytes())
+            pdf.insert_pdf(doc)
+        xrefs = {item[0] for page in pdf for item in page.get_images()}
+        self.assertEqual(len(xrefs), 2)
+
+        db_pkpass.DECODE_STATS.clear()
+        memo = {}
+        barcodes = db_pkpass.extract_barcodes(pdf, limit=0, memo=memo)
+        self.assertEqual(barcodes, [(b'ticket', 'PKBarcodeFormatAztec')])
+        db_pkpass.extract_barcodes(pdf, limit=0, memo=memo)
+        self.assertEqual(db_pkpass.DECODE_STATS, {'native': 1})
+
+    def test_same_stream_other_dictionary(self):
+        import cv2
+        import numpy
+        import zxingcpp
+
+        barcode = zxingcpp.create_barcode('ticket', zxingcpp.BarcodeFormat.Aztec)
+        _, png = cv2.imencode('.png', numpy.array(barcode.to_image(scale=4)))
+
+        # the same stream once more, inverted by /Decode
+        pdf = pymupdf.open()
+        for _ in range(2):
+            doc = pymupdf.open()
+            page = doc.new_page()
+            page.insert_image(pymupdf.Rect(40, 40, 200, 200), stream=png.tobytes())
+            pdf.insert_pdf(doc)
+        first, second = (page.get_images()[0][0] for page in pdf)
+        self.assertEqual(pdf.xref_stream_raw(first), pdf.xref_stream_raw(second))
+        pdf.xref_set_key(second, 'Decode', '[1 0]')
+
+        db_pkpass.DECODE_STATS.clear()
+        memo = {}
+        db_pkpass.extract_barcodes(pdf, limit=0, memo=memo)
+        self.assertNotEqual(memo[first], memo[second])
+        self.assertGreaterEqual(sum(db_pkpass.DECODE_STATS.values()), 2)
+
+    def test_threads(self):
+        import cv2
+        import numpy
+        import zxingcpp
+
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        for i in range(5):
+            barcode = zxingcpp.create_barcode(
+                f'ticket {i}', zxingcpp.BarcodeFormat.Aztec
+            )
+            img = numpy.array(barcode.to_image(scale=4 + i))
+            _, png = cv2.imencode('.png', img)
+            rect = pymupdf.Rect(40, 40 + 150 * i, 160, 160 + 150 * i)
+            page.insert_image(rect, stream=png.tobytes())
+
+        expected = [
+            (f'ticket {i}'.encode(), 'PKBarcodeFormatAztec') for i in range(5)
+        ]
+        for limit in [0, 2]:
+            self.assertEqual(
+                db_pkpass.extract_barcodes(pdf, limit=limit, threads=3),
+                expected[:limit or None],
+            )
+
+
+class DecodeLadderTests(unittest.TestCase):
+    def extract(self, img, ladder=True):
+        import cv2
+
+        _, png = cv2.imencode('.png', img)
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        page.insert_image(pymupdf.Rect(40, 40, 200, 200), stream=png.tobytes())
+        db_pkpass.DECODE_STATS.clear()
+        barcodes = db_pkpass.extract_barcodes(pdf, ladder=ladder)
+        return [message for message, _ in barcodes], db_pkpass.DECODE_STATS
+
+    def aztec(self, scale):
+        import numpy
+        import zxingcpp
+
+        barcode = zxingcpp.create_barcode('ticket', zxingcpp.BarcodeFormat.Aztec)
+        return numpy.array(barcode.to_image(scale=scale))
+
+    def transparent(self):
+        # black with the barcode only in the alpha channel, so it is only
+        # visible when rendered on the page
+        import numpy
+
+        img = self.aztec(4)
+        bgra = numpy.zeros(img.shape + (4,), numpy.uint8)
+        bgra[..., 3] = 255 - img
+        return bgra
+
+    def test_reduced(self):
+        img = self.aztec(140)
+        self.assertGreaterEqual(img.shape[0], 2 * db_pkpass.REDUCED_SIZE)
+        self.assertEqual(self.extract(img), ([b'ticket'], {'reduced': 1}))
+
+    def test_render(self):
+        self.assertEqual(
+            self.extract(self.transparent()), ([b'ticket'], {'render': 1})
+        )
+
+    def test_trace(self):
+        import cv2
+
+        _, png = cv2.imencode('.png', self.transparent())
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        page.insert_image(pymupdf.Rect(40, 40, 200, 200), stream=png.tobytes())
+        for threads in [1, 2]:
+            with db_pkpass.profile() as events:
+                db_pkpass.extract_barcodes(pdf, threads=threads)
+            self.assertEqual(
+                [e['args']['tier'] for e in events if e['name'] == 'image'],
+                ['render'],
+            )
+
+    def test_no_ladder(self):
+        self.assertEqual(
+            self.extract(self.aztec(140), ladder=False),
+            ([b'ticket'], {'native': 1}),
+        )
+        self.assertEqual(
+            self.extract(self.transparent(), ladder=False), ([], {'none': 1})
+        )
+
+
+class ExtractContentTests(unittest.TestCase):
+    def test_pages_loaded_once(self):
+        import bench
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'ticket.pdf')
+        bench.generate_ticket(path, legs=24, extra_pages=2)
+        pdf = pymupdf.open(path)
+
+        with (
+            unittest.mock.patch.object(
+                pdf, 'load_page', wraps=pdf.load_page
+            ) as load_page,
+            db_pkpass.profile() as events,
+        ):
+            content = db_pkpass.extract_content(
+                pdf, skip_boilerplate=False, limit=0
+            )
+        self.assertEqual(len(content['barcodes']), 1)
+        pages = list(range(pdf.page_count))
+        self.assertEqual(
+            [call.args[0] for call in load_page.call_args_list], pages
+        )
+        for name in ['get_text', 'get_images']:
+            self.assertEqual(
+                [e['args']['page'] for e in events if e['name'] == name],
+                pages,
+            )
+
+
+class BudgetTests(unittest.TestCase):
+    def setUp(self):
+        import cv2
+        import numpy
+        import zxingcpp
+
+        barcode = zxingcpp.create_barcode('ticket', zxingcpp.BarcodeFormat.Aztec)
+        img = numpy.array(barcode.to_image(scale=10))
+        self.pdf = pymupdf.open()
+        for ext in ['.jpg', '.png']:
+            _, data = cv2.imencode(ext, img)
+            page = self.pdf.new_page()
+            rect = pymupdf.Rect(40, 40, 200, 200)
+            page.insert_image(rect, stream=data.tobytes())
+        self.pixels = img.shape[0] * img.shape[1]
+
+    def extract(self, page, **kwargs):
+        usage = collections.Counter()
+        pages = [(page, [], page.get_images(full=True))]
+        barcodes = db_pkpass.extract_barcodes(
+            self.pdf, pages=iter(pages), usage=usage, **kwargs
+        )
+        return barcodes, usage
+
+    def test_reduce_jpeg(self):
+        with self.assertWarnsRegex(UserWarning, 'at 1/2 scale'):
+            barcodes, usage = self.extract(
+                self.pdf[0], max_image_pixels=self.pixels // 2
+            )
+        self.assertEqual(len(barcodes), 1)
+        self.assertEqual(usage['reduced'], 1)
+        self.assertLessEqual(usage['pixels'], self.pixels // 2)
+
+    def test_skip_other(self):
+        with self.assertWarnsRegex(UserWarning, 'more than'):
+            barcodes, usage = self.extract(
+                self.pdf[1], max_image_pixels=self.pixels // 2
+            )
+        self.assertEqual(barcodes, [])
+        self.assertEqual(usage, {'skipped': 1})
+
+    def test_total(self):
+        with self.assertWarnsRegex(UserWarning, 'of 1000 left'):
+            barcodes, usage = self.extract(self.pdf[0], max_total_pixels=1000)
+        self.assertEqual(barcodes, [])
+
+    def test_pages(self):
+        with self.assertWarnsRegex(UserWarning, 'after page 1 of 2'):
+            pages = list(db_pkpass.visit_pages(self.pdf, max_total_pages=1))
+        self.assertEqual(len(pages), 1)
+
+    @unittest.skipUnless(
+        os.path.exists('/proc/self/clear_refs'), 'needs Linux to measure RSS'
+    )
+    def test_render_within_budget(self):
+        import cv2
+        import numpy
+
+        # a large JPEG without a barcode, which the ladder would render
+        size = 6000
+        img = numpy.tile(numpy.arange(size) * 255 // size, (size, 1))
+        _, jpg = cv2.imencode('.jpg', img.astype(numpy.uint8))
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'scan.pdf')
+        pdf = pymupdf.open()
+        page = pdf.new_page()
+        page.insert_image(pymupdf.Rect(40, 40, 500, 500), stream=jpg.tobytes())
+        pdf.save(path)
+
+        # a fresh process, so the peak RSS only grows with this PDF
+        code = (
+            'import collections, json, sys, warnings\n'
+            'import bench, db_pkpass, pymupdf\n'
+            'db_pkpass._warm_up()\n'
+            'pdf = pymupdf.open(sys.argv[1])\n'
+            'open("/proc/self/clear_refs", "w").write("5")\n'
+            'rss = bench._status("VmRSS")\n'
+            'usage = collections.Counter()\n'
+            'warnings.simplefilter("ignore")\n'
+            'db_pkpass.extract_barcodes(\n'
+            '    pdf, limit=0, max_image_pixels=4_000_000, usage=usage\n'
+            ')\n'
+            'print(json.dumps([usage, bench._status("VmHWM") - rss]))\n'
+        )
+        out = subprocess.check_output(
+            [sys.executable, '-c', code, path],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        )
+        usage, kib = json.loads(out)
+        self.assertEqual(usage, {'pixels': 1500 * 1500, 'reduced': 1})
+        # decoding the image at full size would take size * size bytes
+        self.assertLess(kib * 1024, size * size // 2)
+
+    def test_default_pages(self):
+        with unittest.mock.patch.object(db_pkpass, 'MAX_TOTAL_PAGES', 1):
+            with self.assertWarnsRegex(UserWarning, 'after page 1 of 2'):
+                barcodes = db_pkpass.extract_barcodes(self.pdf, limit=0)
+            self.assertEqual(len(barcodes), 1)
+            with self.assertWarnsRegex(UserWarning, 'after page 1 of 2'):
+                list(db_pkpass.iter_lines(self.pdf))
+
+    def test_content(self):
+        import bench
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'ticket.pdf')
+        bench.generate_ticket(path)
+        pdf = pymupdf.open(path)
+
+        db_pkpass.BUDGET_STATS.clear()
+        with db_pkpass.profile() as events:
+            db_pkpass.extract_content(pdf)
+        self.assertGreater(db_pkpass.BUDGET_STATS['pixels'], 0)
+        budget, = [e for e in events if e['name'] == 'budget']
+        self.assertEqual(budget['args'], dict(db_pkpass.BUDGET_STATS))
+
+
+class ExportTests(unittest.TestCase):
+    header = {'id_label': 'Auftragsnummer', 'id_value': '123'}
+    legs = [{
+        'start': {
+            'station': 'Berlin Hbf',
+            'datetime': datetime.datetime(2022, 4, 22, 6, tzinfo=db_pkpass.TZ),
+            'platform': '1',
+        },
+        'destination': {
+            'station': 'Hamburg Hbf',
+            'datetime': datetime.datetime(2022, 4, 22, 8, tzinfo=db_pkpass.TZ),
+        },
+        'train': 'ICE 100',
+    }]
+
+    def test_leg_records(self):
+        records = list(db_pkpass.leg_records(self.header, self.legs))
+        self.assertEqual(records, [{
+            'id_label': 'Auftragsnummer',
+            'id_value': '123',
+            'leg': 1,
+            'train': 'ICE 100',
+            'comment': None,
+            'start_station': 'Berlin Hbf',
+            'start_datetime': '2022-04-22T06:00:00+02:00',
+            'start_platform': '1',
+            'destination_station': 'Hamburg Hbf',
+            'destination_datetime': '2022-04-22T08:00:00+02:00',
+            'destination_platform': None,
+        }])
+
+    def test_csv(self):
+        def extract_itinerary(path):
+            if path == 'bad.pdf':
+                raise ValueError('bad')
+            records = list(db_pkpass.leg_records(self.header, self.legs))
+            return [record | {'ticket': 1} for record in records]
+
+        fh = io.StringIO()
+        with unittest.mock.patch.object(
+            db_pkpass, 'extract_itinerary', extract_itinerary
+        ):
+            results = list(db_pkpass.export_legs(
+                ['a.pdf', 'bad.pdf', 'b.pdf'], fh, 'csv', jobs=1
+            ))
+
+        self.assertEqual(results, [
+            ('a.pdf', 1, None),
+            ('bad.pdf', 0, 'ValueError: bad'),
+            ('b.pdf', 1, None),
+        ])
+        rows = list(csv.DictReader(io.StringIO(fh.getvalue())))
+        self.assertEqual([row['file'] for row in rows], ['a.pdf', 'b.pdf'])
+        self.assertEqual(rows[0]['destination_platform'], '')
+        self.assertEqual(list(rows[0]), db_pkpass.LEG_FIELDS)
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        db_pkpass.CACHE_STATS.clear()
+
+    def test_roundtrip(self):
+        key = db_pkpass.cache_key(b'%PDF-1.7', {'limit': 1})
+        self.assertIsNone(db_pkpass.cache_get(key, self.tmp.name))
+        db_pkpass.cache_put(key, {'serialNumber': '1'}, self.tmp.name)
+        self.assertEqual(
+            db_pkpass.cache_get(key, self.tmp.name), {'serialNumber': '1'}
+        )
+        self.assertEqual(
+            db_pkpass.CACHE_STATS, {'hits': 1, 'misses': 1, 'writes': 1}
+        )
+
+    def test_evicted_while_reading(self):
+        key = db_pkpass.cache_key(b'%PDF-1.7', {})
+        db_pkpass.cache_put(key, {'serialNumber': '1'}, self.tmp.name)
+
+        def utime(path):
+            os.remove(path)
+            raise FileNotFoundError(path)
+
+        with unittest.mock.patch('os.utime', utime):
+            self.assertEqual(
+                db_pkpass.cache_get(key, self.tmp.name), {'serialNumber': '1'}
+            )
+
+    def test_key_depends_on_options(self):
+        self.assertNotEqual(
+            db_pkpass.cache_key(b'%PDF-1.7', {'limit': 1}),
+            db_pkpass.cache_key(b'%PDF-1.7', {'limit': 0}),
+        )
+
+    def test_key_from_path(self):
+        data = b'%PDF-1.7' * db_pkpass.CHUNK_SIZE
+        path = os.path.join(self.tmp.name, 'ticket.pdf')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        self.assertEqual(
+            db_pkpass.cache_key(path, {}),
+            db_pkpass.cache_key(memoryview(data), {}),
+        )
+
+    def test_evict_by_size(self):
+        now = datetime.datetime.now().timestamp()
+        for i in range(3):
+            db_pkpass.cache_put(str(i), {'i': i}, self.tmp.name)
+            path = os.path.join(self.tmp.name, f'{i}.json')
+            os.utime(path, (now + i, now + i))
+        db_pkpass.cache_evict(self.tmp.name, max_size=20)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['1.json', '2.json'])
+
+    def test_evict_by_age(self):
+        db_pkpass.cache_put('old', {}, self.tmp.name)
+        os.utime(os.path.join(self.tmp.name, 'old.json'), (0, 0))
+        db_pkpass.cache_put('new', {}, self.tmp.name)
+        db_pkpass.cache_evict(self.tmp.name)
+        self.assertEqual(os.listdir(self.tmp.name), ['new.json'])
+
+    def test_evict_while_writing(self):
+        db_pkpass.cache_put('old', {}, self.tmp.name)
+        os.utime(os.path.join(self.tmp.name, 'old.json'), (0, 0))
+        db_pkpass.cache_put('new', {}, self.tmp.name, evict_interval=3)
+        self.assertIn('old.json', os.listdir(self.tmp.name))
+        db_pkpass.cache_put('newer', {}, self.tmp.name, evict_interval=3)
+        self.assertEqual(
+            sorted(os.listdir(self.tmp.name)), ['new.json', 'newer.json']
+        )
+
+
+class UnseekableWriter(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+
+class PkpassTests(unittest.TestCase):
+    def test_write_unseekable_chunks(self):
+        fh = UnseekableWriter()
+        db_pkpass.write_pkpass(fh, {
+            'pass.json': iter([b'{"a":', b' 1}']),
+            'icon.png': b'png',
+        })
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(fh.chunks))) as zfh:
+            self.assertEqual(zfh.read('pass.json'), b'{"a": 1}')
+            manifest = json.loads(zfh.read('manifest.json'))
+        self.assertEqual(manifest, {
+            'pass.json': hashlib.sha1(b'{"a": 1}').hexdigest(),
+            'icon.png': hashlib.sha1(b'png').hexdigest(),
+        })
+
+    def test_compression_policy(self):
+        buf = io.BytesIO()
+        infos = db_pkpass.write_pkpass(buf, {
+            'pass.json': b'{}' * 100,
+            'icon.png': b'png' * 100,
+        })
+        compression = {info.filename: info.compress_type for info in infos}
+        self.assertEqual(compression, {
+            'pass.json': zipfile.ZIP_DEFLATED,
+            'icon.png': zipfile.ZIP_STORED,
+            'manifest.json': zipfile.ZIP_DEFLATED,
+        })
+
+    def test_bundle(self):
+        buf = io.BytesIO()
+        db_pkpass.write_pkpasses(buf, [{'pass.json': b'{}'}] * 2)
+
+        with zipfile.ZipFile(buf) as zfh:
+            self.assertEqual(zfh.namelist(), ['1.pkpass', '2.pkpass'])
+            inner = zipfile.ZipFile(io.BytesIO(zfh.read('2.pkpass')))
+            self.assertEqual(inner.read('pass.json'), b'{}')
+
+    def test_repack(self):
+        src = UnseekableWriter()
+        db_pkpass.write_pkpass(src, {
+            'pass.json': b'{"a": 1}',
+            'icon.png': b'png' * 100,
+        })
+
+        buf = io.BytesIO()
+        db_pkpass.repack_pkpass(
+            io.BytesIO(b''.join(src.chunks)), buf, {'pass.json': b'{"a": 2}'}
+        )
+
+        with zipfile.ZipFile(buf) as zfh:
+            self.assertIsNone(zfh.testzip())
+            self.assertEqual(zfh.read('pass.json'), b'{"a": 2}')
+            self.assertEqual(zfh.read('icon.png'), b'png' * 100)
+            manifest = json.loads(zfh.read('manifest.json'))
+        self.assertEqual(manifest, {
+            'icon.png': hashlib.sha1(b'png' * 100).hexdigest(),
+            'pass.json': hashlib.sha1(b'{"a": 2}').hexdigest(),
+        })
+
+    def test_repack_signed(self):
+        src = io.BytesIO(db_pkpass.dump_pkpass(
+            {'pass.json': b'{"a": 1}'}, sign=lambda data: b'signature'
+        ))
+        buf = io.BytesIO()
+        with self.assertWarnsRegex(UserWarning, 'dropping the signature'):
+            db_pkpass.repack_pkpass(src, buf, {'pass.json': b'{"a": 2}'})
+        with zipfile.ZipFile(buf) as zfh:
+            self.assertEqual(zfh.namelist(), ['pass.json', 'manifest.json'])
+
+        src.seek(0)
+        buf = io.BytesIO()
+        db_pkpass.repack_pkpass(
+            src, buf, {'pass.json': b'{"a": 2}'}, sign=lambda data: b'new'
+        )
+        with zipfile.ZipFile(buf) as zfh:
+            self.assertEqual(zfh.read('signature'), b'new')
+
+
+def convert_or_crash(path, **kwargs):
+    # dies like a worker after a segfault or OOM kill instead of raising
+    name = os.path.splitext(os.path.basename(path))[0]
+    if name == 'crash':
+        os._exit(1)
+    if name == 'bad':
+        raise ValueError('bad')
+    return path.upper()
+
+
+class BatchTests(unittest.TestCase):
+    def test_iter_paths(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ['b.pdf', 'a.pdf', 'c.json']:
+            open(os.path.join(tmp.name, name), 'w').close()
+
+        paths = db_pkpass.iter_paths([
+            tmp.name, os.path.join(tmp.name, '*.json'), 'ticket.pdf'
+        ])
+        self.assertEqual(list(paths), [
+            os.path.join(tmp.name, 'a.pdf'),
+            os.path.join(tmp.name, 'b.pdf'),
+            os.path.join(tmp.name, 'c.json'),
+            'ticket.pdf',
+        ])
+
+    def test_imap(self):
+        for jobs in [1, 2]:
+            results = db_pkpass.imap(
+                convert_or_crash, ['a', 'bad', 'b'], jobs=jobs
+            )
+            self.assertEqual(list(results), [
+                ('a', 'A', None),
+                ('bad', None, 'ValueError: bad'),
+                ('b', 'B', None),
+            ])
+
+    def test_imap_worker_died(self):
+        items = ['crash'] + [f'x{i}' for i in range(8)]
+        results = list(db_pkpass.imap(convert_or_crash, items, jobs=2))
+        self.assertEqual([item for item, _, _ in results], items)
+        self.assertRegex(results[0][2], '^BrokenProcessPool: ')
+        # the pool is replaced, so items after those in flight succeed
+        self.assertEqual(results[-1], ('x7', 'X7', None))
+
+    def test_summary(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ['a.pdf', 'b.pdf']:
+            with open(os.path.join(tmp.name, name), 'wb') as fh:
+                fh.write(b'junk')
+
+        proc = subprocess.run(
+            [sys.executable, 'db_pkpass.py', '--no-cache', '-j', '1', tmp.name],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(proc.returncode, 1)
+        self.assertEqual(proc.stdout, '')
+        lines = proc.stderr.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1], '0 converted, 2 failed, 0 from cache')
+
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.spool = os.path.join(tmp.name, 'spool')
+        self.done = os.path.join(tmp.name, 'done')
+        self.failed = os.path.join(tmp.name, 'failed')
+        os.mkdir(self.spool)
+
+    def watch(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=db_pkpass.watch, args=(
+            self.spool, self.done, self.failed
+        ), kwargs={'jobs': 1, 'settle': 0.1, 'stop': stop, 'cache': False})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+
+    def drop_failing(self, name):
+        # drops a PDF into the spool and returns its error once it failed
+        with open(os.path.join(self.spool, f'{name}.pdf'), 'wb') as fh:
+            fh.write(b'junk')
+        error_path = os.path.join(self.failed, f'{name}.error.txt')
+        deadline = time.monotonic() + 30
+        while not os.path.exists(error_path):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.1)
+        with open(error_path) as fh:
+            return fh.read()
+
+    def test_failed_pdf_is_moved(self):
+        self.watch()
+        self.drop_failing('junk')
+        self.assertEqual(sorted(os.listdir(self.failed)), [
+            'junk.error.txt', 'junk.pdf'
+        ])
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_worker_died(self):
+        with unittest.mock.patch.object(db_pkpass, 'convert', convert_or_crash):
+            self.watch()
+            self.assertRegex(self.drop_failing('crash'), '^BrokenProcessPool: ')
+            # the pool is replaced and keeps converting
+            self.assertEqual(self.drop_failing('bad'), 'ValueError: bad\n')
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_other_file_system(self):
+        def rename(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src, dst)
+
+        with (
+            unittest.mock.patch('os.rename', rename),
+            unittest.mock.patch('os.replace', rename),
+        ):
+            self.watch()
+            self.drop_failing('junk')
+        self.assertEqual(sorted(os.listdir(self.failed)), [
+            'junk.error.txt', 'junk.pdf'
+        ])
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_file_removed(self):
+        move = db_pkpass._move
+
+        def remove_and_move(path, directory):
+            if path.endswith('gone.pdf'):
+                os.remove(path)
+            move(path, directory)
+
+        with unittest.mock.patch.object(db_pkpass, '_move', remove_and_move):
+            self.watch()
+            path = os.path.join(self.spool, 'gone.pdf')
+            with open(path, 'wb') as fh:
+                fh.write(b'junk')
+            deadline = time.monotonic() + 30
+            while os.path.exists(path):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.1)
+            # the loop goes on with the next file
+            self.drop_failing('junk')
+        self.assertEqual(sorted(os.listdir(self.failed)), [
+            'junk.error.txt', 'junk.pdf'
+        ])
+
+
+class ServiceTests(unittest.IsolatedAsyncioTestCase):
+    async def start(self, max_pending):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        server, _tasks = await db_pkpass.start_service(
+            'localhost', 0, executor, max_pending, cache=False
+        )
+        return server
+
+    async def send(self, server, request):
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('localhost', port)
+        writer.write(request)
+        await writer.drain()
+        return reader, writer
+
+    async def status(self, reader, writer):
+        response = await reader.read()
+        writer.close()
+        return response.split(b'\r\n', 1)[0]
+
+    async def request(self, max_pending, request):
+        server = await self.start(max_pending)
+        async with server:
+            return await self.status(*await self.send(server, request))
+
+    async def test_method_not_allowed(self):
+        status = await self.request(1, b'GET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(status, b'HTTP/1.1 405 Method Not Allowed')
+
+    async def test_invalid_pdf(self):
+        status = await self.request(
+            1, b'POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\njunk'
+        )
+        self.assertEqual(status, b'HTTP/1.1 422 Unprocessable Content')
+
+    async def test_saturated(self):
+        status = await self.request(
+            0, b'POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\njunk'
+        )
+        self.assertEqual(status, b'HTTP/1.1 503 Service Unavailable')
+
+    async def test_negative_length(self):
+        status = await self.request(
+            1, b'POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n'
+        )
+        self.assertEqual(status, b'HTTP/1.1 400 Bad Request')
+
+    async def test_idle_client(self):
+        # a client that never sends its body must not take the only slot
+        server = await self.start(1)
+        with unittest.mock.patch.object(db_pkpass, 'REQUEST_TIMEOUT', 0.5):
+            async with server:
+                idle = await self.send(
+                    server, b'POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\n'
+                )
+                await asyncio.sleep(0.1)
+                status = await self.status(*await self.send(
+                    server, b'POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\njunk'
+                ))
+                self.assertEqual(status, b'HTTP/1.1 422 Unprocessable Content')
+                status = await self.status(*idle)
+                self.assertEqual(status, b'HTTP/1.1 408 Request Timeout')
+
+
+class ProfileTests(unittest.TestCase):
+    def test_span(self):
+        with db_pkpass.profile() as events:
+            with db_pkpass.span('outer', page=0) as args:
+                args['width'] = 10
+        with db_pkpass.span('ignored'):
+            pass
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['name'], 'outer')
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[0]['args'], {'page': 0, 'width': 10})
+
+
+class ImportTests(unittest.TestCase):
+    # packing JSON and dump_pkpass must not pay for the extraction libraries
+    BUDGET = 0.25
+
+    def test_import_is_cheap(self):
+        code = (
+            'import sys, time\n'
+            't = time.perf_counter()\n'
+            'import db_pkpass\n'
+            'print(time.perf_counter() - t)\n'
+            'heavy = {"cv2", "numpy", "pymupdf", "zxingcpp"}\n'
+            'print(*sorted(heavy & set(sys.modules)))\n'
+        )
+        out = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        )
+        seconds, modules = out.split('\n', 1)
+        self.assertEqual(modules.strip(), '')
+        self.assertLess(float(seconds), self.BUDGET)
+
+
+@unittest.skipUnless(PERF, 'set DB_PKPASS_PERF=1 to compare performance')
+class PerfTests(unittest.TestCase):
+    RUNS = 5
+    # a measurement fails if it exceeds baseline * factor + slack
+    TOLERANCE = {
+        'time_ms': (2, 5),
+        'peak_kib': (1.5, 64),
+    }
+
+    def measure(self, fn):
+        fn()  # warm up
+        times = []
+        for _ in range(self.RUNS):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {
+            'time_ms': round(statistics.median(times) * 1000, 2),
+            'peak_kib': round(peak / 1024, 1),
+        }
+
+    def fixtures(self, tmp):
+        import bench
+
+        for path in sorted(glob.glob('muster/*.pdf')):
+            yield os.path.splitext(os.path.basename(path))[0], path
+        for name, kwargs in bench.SYNTHETIC.items():
+            path = os.path.join(tmp, f'{name}.pdf')
+            bench.generate_ticket(path, **kwargs)
+            yield name, path
+
+    def test_baseline(self):
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, path in self.fixtures(tmp):
+                with db_pkpass.open_pdf(path) as pdf:
+                    content = db_pkpass.extract_content(pdf)
+                    files = db_pkpass.pass_files(content)
+                    results[name] = {
+                        'extract': self.measure(
+                            lambda: db_pkpass.extract(pdf)
+                        ),
+                        'extract_content': self.measure(
+                            lambda: db_pkpass.extract_content(pdf)
+                        ),
+                        'dump_pkpass': self.measure(
+                            lambda: db_pkpass.dump_pkpass(files)
+                        ),
+                    }
+
+        if PERF == 'update':
+            with open(PERF_BASELINE, 'w') as fh:
+                json.dump(results, fh, indent=2, sort_keys=True)
+                fh.write('\n')
+            return
+
+        with open(PERF_BASELINE) as fh:
+            baseline = json.load(fh)
+        lines = []
+        missing = []
+        for name, stages in results.items():
+            for stage, values in stages.items():
+                for key, value in values.items():
+                    try:
+                        before = baseline[name][stage][key]
+                    except KeyError:
+                        # new fixtures must not pass unchecked
+                        missing.append(f'{name:30} {stage:16} {key}')
+                        continue
+                    factor, slack = self.TOLERANCE[key]
+                    limit = before * factor + slack
+                    if value > limit:
+                        lines.append(
+                            f'{name:30} {stage:16} {key:8} '
+                            f'{before:10.1f} -> {value:10.1f} '
+                            f'(limit {limit:.1f})'
+                        )
+        message = []
+        if lines:
+            message += [f'slower or bigger than {PERF_BASELINE}:', *lines]
+        if missing:
+            message += [
+                f'not in {PERF_BASELINE}, run with DB_PKPASS_PERF=update:',
+                *missing,
+            ]
+        if message:
+            self.fail('\n'.join(message))